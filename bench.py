@@ -0,0 +1,184 @@
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import tensorflow as tf
+
+import core
+import config
+import inference
+
+# the stages of one control step, in the order they run
+STAGES = ['neighbors', 'cbf', 'action', 'refine', 'safety', 'baseline']
+PERCENTILES = [50, 90, 99]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, nargs='+', default=[8, 64, 512, 4096])
+    parser.add_argument('--top_k', type=int, nargs='+', default=[config.TOP_K])
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--formation_fraction', type=float, default=0.0)
+    parser.add_argument('--refine', type=str, default=config.REFINE_MODE, choices=['gradient', 'qp'])
+    parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='bench.json')
+    parser.add_argument('--gpu', type=str, default='0')
+    args = parser.parse_args()
+    return args
+
+
+def time_call(fn, repeats, warmup):
+    """ Returns the wall time in seconds of each of repeats calls of fn, after
+    warmup calls that are not timed. """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return np.array(times)
+
+
+def summarize(times, num_agents):
+    """ Reduces the times of one stage to latency percentiles in milliseconds
+    and the throughput in agents per second. """
+    summary = {'p{}_ms'.format(q): 1000 * float(np.percentile(times, q)) for q in PERCENTILES}
+    summary['mean_ms'] = 1000 * float(np.mean(times))
+    summary['agents_per_s'] = float(num_agents / np.mean(times))
+    return summary
+
+
+def build_stage_graph(num_agents, top_k, batch_size=None, refine=config.REFINE_MODE):
+    """ Builds the control step with every stage fetchable on its own.
+
+    A stage is timed by feeding the outputs of the stages before it, which
+    TensorFlow allows for any tensor, so only its own ops run.
+
+    Returns:
+        s, g: The state and goal placeholders.
+        neighbors (Neighbors): The output of the neighbor selection.
+        h, mask: The outputs of network_cbf.
+        a: The output of network_action.
+        a_opt, refine_steps: The outputs of the refinement.
+    """
+    batch_shape = [] if batch_size is None else [batch_size]
+    s = tf.placeholder(tf.float32, batch_shape + [num_agents, 4])
+    g = tf.placeholder(tf.float32, batch_shape + [num_agents, 2])
+    neighbors = core.build_neighbors(s, top_k)
+    h, mask, _ = core.network_cbf(s=s, r=config.DIST_MIN_THRES, neighbors=neighbors)
+    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, neighbors=neighbors)
+    if refine == 'qp':
+        a_res, refine_steps = core.refine_action_qp(s=s, a=a, h=h, mask=mask, neighbors=neighbors)
+    else:
+        a_res, refine_steps = core.refine_action_gradient(s=s, a=a, h=h, mask=mask, neighbors=neighbors)
+    return s, g, neighbors, h, mask, a, a + a_res, refine_steps
+
+
+def bench_setting(num_agents, top_k, args):
+    """ Times every stage of the control step for one agent count and TOP_K.
+
+    Returns:
+        results (list): One record per stage.
+    """
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    batch = 1 if args.batch_size is None else args.batch_size
+    # with a formation_fraction, the first agents are packed in a formation as
+    # in evaluate, which stresses the neighbor search with a dense cluster
+    num_formation = int(num_agents * args.formation_fraction)
+    if num_formation > 0:
+        s_np, g_np = [np.stack(x) for x in zip(*[
+            core.formation_scenario(num_agents, num_formation, config.DIST_MIN_THRES)[:2]
+            for _ in range(batch)])]
+    else:
+        s_np, g_np = [np.stack(x) for x in zip(*[
+            core.generate_data(num_agents, config.DIST_MIN_THRES, seed=rng.randint(2 ** 31))
+            for _ in range(batch)])]
+    # random velocities give the refinement constraints to correct
+    s_np[..., 2:] = rng.normal(size=s_np[..., 2:].shape) * 0.5
+    if args.batch_size is None:
+        s_np, g_np = s_np[0], g_np[0]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        s, g, neighbors, h, mask, a, a_opt, refine_steps = build_stage_graph(
+            num_agents, top_k, args.batch_size, args.refine)
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        if args.model_path:
+            vars_restore = [v for v in tf.global_variables() if 'action' in v.name or 'cbf' in v.name]
+            tf.train.Saver(var_list=vars_restore).restore(sess, args.model_path)
+
+    feed = {s: s_np, g: g_np}
+    neighbors_np = sess.run(neighbors, feed_dict=feed)
+    feed_neighbors = dict(feed)
+    feed_neighbors.update(zip(neighbors, neighbors_np))
+    h_np, mask_np, a_np = sess.run([h, mask, a], feed_dict=feed_neighbors)
+    feed_refine = dict(feed_neighbors)
+    feed_refine.update({h: h_np, mask: mask_np, a: a_np})
+    s_next = core.integrate(s_np, sess.run(a_opt, feed_dict=feed_refine))
+
+    calls = {
+        'neighbors': lambda: sess.run(neighbors, feed_dict=feed),
+        'cbf': lambda: sess.run([h, mask], feed_dict=feed_neighbors),
+        'action': lambda: sess.run(a, feed_dict=feed_neighbors),
+        'refine': lambda: sess.run([a_opt, refine_steps], feed_dict=feed_refine),
+        'safety': lambda: core.ttc_dangerous_count_np(
+            s_next, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK),
+        'baseline': lambda: core.lqr_baseline_np(s_np, g_np, steps=1),
+    }
+    results = []
+    for stage in STAGES:
+        times = time_call(calls[stage], args.repeats, args.warmup)
+        result = {'num_agents': num_agents, 'top_k': top_k, 'batch_size': batch, 'stage': stage}
+        result.update(summarize(times, num_agents * batch))
+        results.append(result)
+    result = results[STAGES.index('refine')]
+    result['iterations'] = int(sess.run(refine_steps, feed_dict=feed_refine))
+    # the candidates ranked by the neighbor search bound its memory, and stay
+    # O(k) per agent however dense the formation is
+    result = results[STAGES.index('neighbors')]
+    result['candidates_per_agent'] = len(inference.neighbor_candidates(s_np, top_k)[0]) / float(num_agents * batch)
+    sess.close()
+    return results
+
+
+def main():
+    args = parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    results = []
+    for num_agents in args.num_agents:
+        for top_k in args.top_k:
+            setting = bench_setting(num_agents, top_k, args)
+            results.extend(setting)
+            print('N = {:5d}, TOP_K = {:3d} | '.format(num_agents, top_k) + ', '.join(
+                '{}: {:.2f} ms'.format(r['stage'], r['p50_ms']) for r in setting) +
+                ' | candidates/agent: {:.1f}'.format(setting[0]['candidates_per_agent']))
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'tensorflow': tf.__version__},
+        'settings': {'refine': args.refine, 'repeats': args.repeats, 'warmup': args.warmup,
+                     'formation_fraction': args.formation_fraction, 'neighbor_levels': config.NEIGHBOR_LEVELS,
+                     'model_path': args.model_path, 'integrator': config.INTEGRATOR,
+                     'refine_loops': config.REFINE_LOOPS, 'qp_iterations': config.QP_ITERATIONS,
+                     'qp_linearizations': config.QP_LINEARIZATIONS},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote {} results to {}'.format(len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
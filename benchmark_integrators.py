@@ -0,0 +1,68 @@
+import sys
+sys.dont_write_bytecode = True
+
+import time
+import argparse
+import numpy as np
+
+import core
+import config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=64)
+    parser.add_argument('--num_scenarios', type=int, default=16)
+    parser.add_argument('--horizon', type=float, default=5.0)
+    parser.add_argument('--periods', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.4])
+    parser.add_argument('--substeps', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--tolerances', type=float, nargs='+', default=[1e-4, 1e-6])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def simulate(s, g, horizon, dt, method, substeps, tolerance=0.0):
+    """ Runs the LQR baseline for horizon seconds, evaluating it every dt.
+
+    Returns:
+        s (B, N, 4): The final state.
+        elapsed (float): The wall time of the simulation in seconds.
+    """
+    start_time = time.perf_counter()
+    for _ in range(int(round(horizon / dt))):
+        s_ref = np.concatenate([s[..., :2] - g, s[..., 2:]], axis=-1)
+        a = -np.matmul(s_ref, core.LQR_GAIN.T)
+        s = core.integrate(s, a, dt, method, substeps, tolerance)
+    return s, time.perf_counter() - start_time
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    scenarios = [core.generate_data(args.num_agents, config.DIST_MIN_THRES)
+                 for _ in range(args.num_scenarios)]
+    s, g = [np.stack(x).astype(np.float64) for x in zip(*scenarios)]
+
+    # the continuous-time closed loop, approximated by a very short control period
+    s_continuous, _ = simulate(s, g, args.horizon, 1e-3, 'rk4', 1)
+
+    print('{:>8} {:>20} {:>8} {:>10} {:>10} {:>12} {:>12}'.format(
+        'period', 'integrator', 'substeps', 'tolerance', 'ms/step', 'sim error', 'ctrl error'))
+    for dt in args.periods:
+        # the exact solution under the same control period and held actions
+        s_exact, _ = simulate(s, g, args.horizon, dt, 'rk4', 64)
+        # fixed steps, then steps chosen by step doubling from a single first one
+        settings = [(substeps, 0.0) for substeps in args.substeps] + [
+            (1, tolerance) for tolerance in args.tolerances]
+        for method in sorted(core.INTEGRATORS):
+            for substeps, tolerance in settings:
+                s_final, elapsed = simulate(s, g, args.horizon, dt, method, substeps, tolerance)
+                sim_error = np.mean(np.linalg.norm(s_final[..., :2] - s_exact[..., :2], axis=-1))
+                ctrl_error = np.mean(np.linalg.norm(s_final[..., :2] - s_continuous[..., :2], axis=-1))
+                print('{:>8.3f} {:>20} {:>8d} {:>10.0e} {:>10.3f} {:>12.2e} {:>12.2e}'.format(
+                    dt, method, substeps, tolerance, 1000 * elapsed * dt / args.horizon,
+                    sim_error, ctrl_error))
+
+if __name__ == '__main__':
+    main()
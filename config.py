@@ -1,4 +1,12 @@
 TIME_STEP = 1e-1
+# the integrator of the dynamics, one of core.INTEGRATORS, and the number of
+# its steps per TIME_STEP, over which the action is held
+INTEGRATOR = 'euler'
+INTEGRATOR_SUBSTEPS = 1
+# the local error allowed per step, above 0 to choose the steps by step
+# doubling instead of fixing them, down to TIME_STEP / INTEGRATOR_MAX_SUBSTEPS
+INTEGRATOR_TOLERANCE = 0.0
+INTEGRATOR_MAX_SUBSTEPS = 64
 WEIGHT_DECAY = 1e-8
 
 ALPHA_CBF = 1.0
@@ -9,6 +17,9 @@ DIST_MIN_ENLARGED = 0.05
 
 OBS_RADIUS = 1.0
 TOP_K = 12
+# the number of grid levels of the neighbor search, whose cells shrink from
+# OBS_RADIUS / 2 by half at each level to follow the density of clusters
+NEIGHBOR_LEVELS = 8
 
 TIME_TO_COLLISION = 2.0
 TIME_TO_COLLISION_CHECK = 0.1
@@ -17,11 +28,32 @@ TRAIN_STEPS = 10000
 EVALUATE_STEPS = 10
 INNER_LOOPS = 50
 REFINE_LOOPS = 50
-REFINE_LEARNING_RATE = 0.3
+REFINE_LEARNING_RATE = 2.0
+REFINE_TOLERANCE = 1e-4
+# the relative change of an agent's violation per refinement step below
+# which the agent is considered stalled and stops being refined
+REFINE_MIN_CHANGE = 1e-3
+# 'gradient' runs REFINE_LOOPS descent steps through the CBF network,
+# 'qp' linearizes it up to QP_LINEARIZATIONS times and solves a per-agent QP
+# in at most QP_ITERATIONS steps each, until the correction moves by less
+# than QP_TOLERANCE
+REFINE_MODE = 'gradient'
+QP_ITERATIONS = 30
+QP_LINEARIZATIONS = 3
+QP_TOLERANCE = 1e-4
+# the shape of the leader-follower formation, one of formations.FORMATION_SHAPES,
+# and its extra arguments, e.g. {'points': [[x, y], ...]} for 'points'
+FORMATION_SHAPE = 'circle'
+FORMATION_PARAMS = {}
+# the radius, or spacing, of the formation, shared by the scenarios, the action
+# network and the losses
+FORMATION_SCALE = 0.5
 
 LEARNING_RATE = 1e-4
 DISPLAY_STEPS = 200
 SAVE_STEPS = 1000
+# training steps between weight updates of the rollout workers
+WEIGHT_SYNC_STEPS = 10
 
 ADD_NOISE_PROB = 0.0
 NOISE_SCALE = 0.3
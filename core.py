@@ -1,7 +1,10 @@
+import collections
+
 import numpy as np
 import tensorflow as tf
 
 import config
+import formations
 
 def generate_obstacle_circle(center, radius, num=12):
     theta = np.linspace(0, np.pi*2, num=num, endpoint=False).reshape(-1, 1)
@@ -33,50 +36,66 @@ def generate_obstacle_rectangle(center, sides, num=12):
     return rectangle
 
 
-def generate_data(num_agents, dist_min_thres):
-    side_length = np.sqrt(max(1.0, num_agents / 8.0))
-    states = np.zeros(shape=(num_agents, 2), dtype=np.float32)
-    goals = np.zeros(shape=(num_agents, 2), dtype=np.float32)
+def generate_data(num_agents, dist_min_thres, seed=None):
+    """ Samples well-separated initial states and goals.
 
-    i = 0
-    while i < num_agents:
-        candidate = np.random.uniform(size=(2,)) * side_length
-        dist_min = np.linalg.norm(states - candidate, axis=1).min()
-        if dist_min <= dist_min_thres:
-            continue
-        states[i] = candidate
-        i = i + 1
-
-    i = 0
-    while i < num_agents:
-        candidate = np.random.uniform(-0.5, 0.5, size=(2,)) + states[i]
-        dist_min = np.linalg.norm(goals - candidate, axis=1).min()
-        if dist_min <= dist_min_thres:
-            continue
-        goals[i] = candidate
-        i = i + 1
+    The starts are drawn by jittered grid sampling: the square is split into
+    at least num_agents cells, each agent takes a different cell and is placed
+    at least dist_min_thres / 2 from its borders, so no start is ever rejected.
+    Each goal lies within 0.5 of its start, and only the goals too close to
+    another goal are drawn again, all at once.
+
+    Args:
+        num_agents (int): The number of agents.
+        dist_min_thres (float): The minimum distance between any two starts,
+            and between any two goals.
+        seed (int): Seeds a private generator for a reproducible scenario.
+            If None, the global NumPy generator is used.
+    Returns:
+        states (N, 4): The initial positions, with zero velocity.
+        goals (N, 2): The goal of each agent.
+    """
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    side_length = np.sqrt(max(1.0, num_agents / 8.0))
+    grid = int(np.ceil(np.sqrt(num_agents)))
+    cell_size = side_length / grid
+    if cell_size <= dist_min_thres:
+        raise ValueError('Cannot place {} agents {} apart in a square of side {:.3f}.'.format(
+            num_agents, dist_min_thres, side_length))
+
+    cells = rng.choice(grid * grid, num_agents, replace=False)
+    corners = np.stack([cells // grid, cells % grid], axis=1) * cell_size
+    margin = dist_min_thres / 2
+    states = corners + margin + rng.uniform(size=(num_agents, 2)) * (cell_size - 2 * margin)
+
+    goals = states + rng.uniform(-0.5, 0.5, size=(num_agents, 2))
+    while True:
+        i, j = neighbor_pairs_np(goals, dist_min_thres)
+        close = np.logical_and(
+            i > j, np.linalg.norm(goals[i] - goals[j], axis=1) <= dist_min_thres)
+        redraw = np.unique(i[close])
+        if len(redraw) == 0:
+            break
+        goals[redraw] = states[redraw] + rng.uniform(-0.5, 0.5, size=(len(redraw), 2))
 
     states = np.concatenate(
-        [states, np.zeros(shape=(num_agents, 2), dtype=np.float32)], axis=1)
-    return states, goals
+        [states, np.zeros(shape=(num_agents, 2))], axis=1)
+    return states.astype(np.float32), goals.astype(np.float32)
 
 
 def formation_data(num_agents, dist_min_thres):
     """Generates initial states and goals for agents with a leader-follower formation."""
-    # Check if num_agents is a TensorFlow tensor
     if tf.is_tensor(num_agents):
-        # Evaluate the tensor to get a Python integer
-        with tf.Session() as sess:
-            num_agents = sess.run(num_agents)  # Convert tensor to integer
-    else:
-        # If num_agents is already an integer, use it directly
-        num_agents = int(num_agents)
+        # the count of a graph with a static shape is known without running it
+        num_agents = tf.get_static_value(num_agents)
+        if num_agents is None:
+            raise ValueError('formation_data needs a number of agents known at graph construction.')
+    num_agents = int(num_agents)
 
     leader_position = np.array([0.0, 0.0])
     leader_goal = np.random.uniform(-1.0, 1.0, size=(2,))  # Random goal for leader
 
-    radius = 0.1  # Radius of follower circular formation
-    followers_positions = define_circular_formation(num_agents - 1, radius) + leader_position
+    followers_positions = leader_formation(num_agents)[1:] + leader_position
 
     assert followers_positions.shape == (num_agents - 1, 2), f"Unexpected shape: {followers_positions.shape}"
 
@@ -96,90 +115,170 @@ def formation_data(num_agents, dist_min_thres):
 
     return states, goals
 
+def formation_scenario(num_agents, num_formation, dist_min_thres):
+    """ Generates a scenario with a leader-follower formation among free agents.
+
+    Args:
+        num_agents (int): The total number of agents.
+        num_formation (int): The number of agents in the formation, placed
+            first with the leader at index 0. 0 gives free agents only.
+        dist_min_thres (float): The minimum distance between the free agents.
+    Returns:
+        states (N, 4): The initial states.
+        goals (N, 2): The goal of each agent.
+        formation (num_formation, 2): The initial offsets of the formation
+            agents from the leader.
+    """
+    if num_formation == 0:
+        states, goals = generate_data(num_agents, dist_min_thres)
+        return states, goals, np.zeros((0, 2), dtype=np.float32)
+    formation_states, formation_goals = formation_data(num_formation, dist_min_thres)
+    other_states, other_goals = generate_data(num_agents - num_formation, dist_min_thres)
+    formation = formation_states[:, :2] - formation_states[:1, :2]
+    return (np.vstack([formation_states, other_states]),
+            np.vstack([formation_goals, other_goals]), formation)
+
+def define_formation(num_agents, scale, shape=None):
+    """ Lays out num_agents agents in a formation of the formations registry.
+
+    Layouts are cached by shape, count and scale, and a tensor num_agents is
+    resolved from the static graph without a session. An unknown count gets
+    the same layout as in-graph ops, which only the circle supports.
+
+    Args:
+        num_agents (int or tensor): The number of agents in the layout.
+        scale (float): The radius, or the spacing between neighboring agents.
+        shape (str): The shape, config.FORMATION_SHAPE with
+            config.FORMATION_PARAMS if None.
+    Returns:
+        formation (num_agents, 2): A read-only NumPy array, or a tensor when
+            num_agents is only known at run time.
+    """
+    params = {}
+    if shape is None:
+        shape, params = config.FORMATION_SHAPE, config.FORMATION_PARAMS
+    if tf.is_tensor(num_agents):
+        static_num_agents = tf.get_static_value(num_agents)
+        if static_num_agents is None:
+            if shape != 'circle':
+                raise ValueError('Only the circle formation supports a number of agents known at run time.')
+            # the angles of np.linspace with the endpoint, also for 0 or 1 agents
+            angles = 2.0 * np.pi * tf.cast(tf.range(num_agents), tf.float32) / tf.cast(
+                tf.maximum(num_agents - 1, 1), tf.float32)
+            return scale * tf.stack([tf.cos(angles), tf.sin(angles)], axis=1)
+        num_agents = static_num_agents
+    return formations.formation_offsets(shape, num_agents, scale, **params)
+
+
 def define_circular_formation(num_agents, radius):
-    # Check if num_agents is a TensorFlow tensor
+    return define_formation(num_agents, radius, shape='circle')
+
+
+def leader_formation(num_agents):
+    """ Returns the desired formation of a scenario: the offsets of num_agents
+    agents from their leader in config.FORMATION_SHAPE at config.FORMATION_SCALE,
+    with the leader first at the origin.
+
+    Build it once per scenario and pass it to network_action, loss_actions and
+    loss_formation, so the policy and the losses agree on the formation.
+
+    Args:
+        num_agents (int or tensor): The number of agents in the formation.
+    Returns:
+        formation (num_agents, 2): A cached, read-only NumPy array, or a
+            tensor when num_agents is only known at run time.
+    """
+    if tf.is_tensor(num_agents) and tf.get_static_value(num_agents) is not None:
+        num_agents = tf.get_static_value(num_agents)
     if tf.is_tensor(num_agents):
-        # Evaluate the tensor to get a Python integer
-        with tf.Session() as sess:
-            num_agents = sess.run(num_agents)  # Convert tensor to integer
-    else:
-        # If num_agents is already an integer, use it directly
-        num_agents = int(num_agents)
+        followers = define_formation(num_agents - 1, config.FORMATION_SCALE)
+        return tf.concat([tf.zeros([1, 2]), followers], axis=0)
+    return formations.leader_formation(config.FORMATION_SHAPE, int(num_agents),
+                                       config.FORMATION_SCALE, **config.FORMATION_PARAMS)
 
-    # Use np.linspace with the evaluated integer
-    angles = np.linspace(0.0, 2.0 * np.pi, num_agents)  # Use np.linspace()
-    formation = radius * np.column_stack((np.cos(angles), np.sin(angles)))  # Use np.column_stack()
-    return formation
 
-def network_action(s, g, obs_radius=1.0, indices=None, leader_idx=0, radius=0.5, desired_formation=None, stop_threshold=0.05):
+def agent_count(s):
+    """ The number of agents of s, as an int when its shape is static and as a
+    scalar tensor otherwise. """
+    num_agents = s.get_shape().as_list()[-2]
+    return tf.shape(s)[-2] if num_agents is None else num_agents
+
+def network_action(s, g, obs_radius=1.0, neighbors=None, leader_idx=0, desired_formation=None, stop_threshold=0.05):
     """
     Computes actions for agents while maintaining a leader-follower formation.
 
+    desired_formation: The (M, 2) offsets of the first M agents from the leader,
+        as returned by leader_formation. The other agents are free. If None,
+        every agent is in the configured formation.
     stop_threshold: Distance threshold below which the agent stops moving.
     """
-    num_agents = tf.shape(s)[0]
 
     # Compute distance to goals
-    distances_to_goal = tf.norm(s[:, :2] - g, axis=1, keepdims=True)
+    distances_to_goal = tf.norm(s[..., :2] - g, axis=-1, keepdims=True)
 
     # Mask: If an agent is within stop_threshold, it should stop moving
     stop_mask = tf.cast(distances_to_goal > stop_threshold, tf.float32)
 
     # Compute leader velocity
-    leader_position = s[leader_idx, :2]
-    leader_goal = g[leader_idx]
+    leader_position = s[..., leader_idx:leader_idx + 1, :2]
+    leader_goal = g[..., leader_idx:leader_idx + 1, :]
     leader_velocity = (leader_goal - leader_position)  # Move towards goal
 
-    # Compute desired follower positions
+    # Compute desired positions of the formation agents
     if desired_formation is None:
-        num_followers = num_agents - 1
-        follower_desired_positions = define_circular_formation(num_followers, radius) + leader_position
-    else:
-        follower_desired_positions = desired_formation[1:] + leader_position
+        desired_formation = leader_formation(agent_count(s))
+    desired_formation = tf.cast(desired_formation, tf.float32)
+    num_formation = tf.shape(desired_formation)[0]
 
-    # Compute formation error
-    follower_errors = s[1:, :2] - follower_desired_positions
-    formation_error = tf.concat([tf.zeros((1, 2)), follower_errors], axis=0)
+    # Compute formation error, zero for the leader and the free agents
+    formation_error = s[..., :num_formation, :2] - (desired_formation + leader_position)
+    formation_error = tf.concat([formation_error, tf.zeros_like(s[..., num_formation:, :2])], axis=-2)
 
     # Compute action
-    x = tf.expand_dims(s, 1) - tf.expand_dims(s, 0)
-    x, _ = remove_distant_agents(x=x, k=config.TOP_K, indices=indices)
-    dist = tf.norm(x[:, :, :2], axis=2, keepdims=True)
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K, obs_radius)
+    x = neighbors.x
+    dist = tf.norm(x[..., :2], axis=-1, keepdims=True)
     mask = tf.cast(tf.less(dist, obs_radius), tf.float32)
 
-    # Action network computation
+    # Action network computation, with any batch dimension folded into the agents
+    x = flatten_neighbors(x)
     x = tf.contrib.layers.conv1d(inputs=x, num_outputs=64, kernel_size=1, reuse=tf.AUTO_REUSE, scope='action/conv_1', activation_fn=tf.nn.relu)
-    x = tf.reduce_max(x * mask, axis=1)
-    x = tf.concat([x, s[:, :2] - g, s[:, 2:]], axis=1)
+    x = tf.reduce_max(x * flatten_neighbors(mask), axis=1)
+    x = tf.reshape(x, tf.concat([tf.shape(s)[:-1], [64]], axis=0))
+    x = tf.concat([x, s[..., :2] - g, s[..., 2:]], axis=-1)
     x = tf.contrib.layers.fully_connected(inputs=x, num_outputs=64, reuse=tf.AUTO_REUSE, scope='action/fc_1', activation_fn=tf.nn.relu)
     x = tf.contrib.layers.fully_connected(inputs=x, num_outputs=4, reuse=tf.AUTO_REUSE, scope='action/fc_4', activation_fn=None)
     x = 2.0 * tf.nn.sigmoid(x) + 0.2
-    k_1, k_2, k_3, k_4 = tf.split(x, 4, axis=1)
+    k_1, k_2, k_3, k_4 = tf.split(x, 4, axis=-1)
 
-    gain_x = -tf.concat([k_1, tf.zeros_like(k_1), k_2, tf.zeros_like(k_2)], axis=1)
-    gain_y = -tf.concat([tf.zeros_like(k_3), k_3, tf.zeros_like(k_4), k_4], axis=1)
-    state = tf.concat([s[:, :2] - g, s[:, 2:]], axis=1)
+    gain_x = -tf.concat([k_1, tf.zeros_like(k_1), k_2, tf.zeros_like(k_2)], axis=-1)
+    gain_y = -tf.concat([tf.zeros_like(k_3), k_3, tf.zeros_like(k_4), k_4], axis=-1)
+    state = tf.concat([s[..., :2] - g, s[..., 2:]], axis=-1)
 
     # Compute acceleration (action) and apply stop mask
     formation_gain = 1.0  # Tune this value
     formation_control = formation_gain * formation_error
-    a_x = tf.reduce_sum(state * gain_x, axis=1, keepdims=True) + formation_control[:, 0:1]
-    a_y = tf.reduce_sum(state * gain_y, axis=1, keepdims=True) + formation_control[:, 1:2]
+    a_x = tf.reduce_sum(state * gain_x, axis=-1, keepdims=True) + formation_control[..., 0:1]
+    a_y = tf.reduce_sum(state * gain_y, axis=-1, keepdims=True) + formation_control[..., 1:2]
 
-    a = tf.concat([a_x, a_y], axis=1) * stop_mask  # Apply stop mask here
+    a = tf.concat([a_x, a_y], axis=-1) * stop_mask  # Apply stop mask here
 
     return a
 
-def network_cbf(x, r, indices=None):
+def network_cbf(s, r, neighbors=None):
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
+    x = neighbors.x
     d_norm = tf.sqrt(
-        tf.reduce_sum(tf.square(x[:, :, :2]) + 1e-4, axis=2))
+        tf.reduce_sum(tf.square(x[..., :2]) + 1e-4, axis=-1))
     x = tf.concat([x,
-        tf.expand_dims(tf.eye(tf.shape(x)[0]), 2),
-        tf.expand_dims(d_norm - r, 2)], axis=2)
-    x, indices = remove_distant_agents(x=x, k=config.TOP_K, indices=indices)
+        neighbors.eye,
+        tf.expand_dims(d_norm - r, -1)], axis=-1)
     dist = tf.sqrt(
-        tf.reduce_sum(tf.square(x[:, :, :2]) + 1e-4, axis=2, keepdims=True))
+        tf.reduce_sum(tf.square(x[..., :2]) + 1e-4, axis=-1, keepdims=True))
     mask = tf.cast(tf.less_equal(dist, config.OBS_RADIUS), tf.float32)
+    x = flatten_neighbors(x)
     x = tf.contrib.layers.conv1d(inputs=x, 
                                  num_outputs=64,
                                  kernel_size=1, 
@@ -204,24 +303,168 @@ def network_cbf(x, r, indices=None):
                                  reuse=tf.AUTO_REUSE,
                                  scope='cbf/conv_4', 
                                  activation_fn=None)
-    x = x * mask
-    return x, mask, indices
+    x = tf.reshape(x, tf.shape(mask)) * mask
+    return x, mask, neighbors
 
 
 def dynamics(s, a):
     """ The ground robot dynamics.
     
     Args:
-        s (N, 4): The current state.
-        a (N, 2): The acceleration taken by each agent.
+        s (N, 4) or (B, N, 4): The current state.
+        a (N, 2) or (B, N, 2): The acceleration taken by each agent.
     Returns:
-        dsdt (N, 4): The time derivative of s.
+        dsdt (N, 4) or (B, N, 4): The time derivative of s.
     """
-    dsdt = tf.concat([s[:, 2:], a], axis=1)
+    dsdt = tf.concat([s[..., 2:], a], axis=-1)
     return dsdt
 
 
-def loss_barrier(h, s, r, ttc, indices=None, eps=[1e-3, 0]):
+def dynamics_np(s, a):
+    """ NumPy version of dynamics, shape (..., N, 4). """
+    return np.concatenate([s[..., 2:], a], axis=-1)
+
+
+def euler(f, concat, s, a, dt):
+    return s + f(s, a) * dt
+
+
+def semi_implicit_euler(f, concat, s, a, dt):
+    # the velocity is updated first and then carries the position
+    v = s[..., 2:] + f(s, a)[..., 2:] * dt
+    return concat([s[..., :2] + v * dt, v], axis=-1)
+
+
+def rk4(f, concat, s, a, dt):
+    k_1 = f(s, a)
+    k_2 = f(s + k_1 * (dt / 2), a)
+    k_3 = f(s + k_2 * (dt / 2), a)
+    k_4 = f(s + k_3 * dt, a)
+    return s + (k_1 + 2 * k_2 + 2 * k_3 + k_4) * (dt / 6)
+
+
+# one step of each integrator, mapping (dynamics, concat, s, a, dt) to the next state
+INTEGRATORS = {'euler': euler, 'semi_implicit_euler': semi_implicit_euler, 'rk4': rk4}
+# the order of each integrator, which scales its error estimate in integrate
+INTEGRATOR_ORDERS = {'euler': 1, 'semi_implicit_euler': 1, 'rk4': 4}
+
+
+def step_doubling(step, order, s, a, h):
+    """ Takes one step of h and two of h / 2 and compares them.
+
+    Returns:
+        s_next (N, 4) or (B, N, 4): The two half steps, extrapolated with their
+            difference to one order higher.
+        error (N, 4) or (B, N, 4): The estimated local error of the half steps.
+    """
+    s_full = step(s, a, h)
+    s_half = step(step(s, a, h / 2), a, h / 2)
+    error = (s_half - s_full) / (2 ** order - 1)
+    return s_half + error, error
+
+
+def step_factor(error, tolerance, order):
+    # grows or shrinks the step towards the tolerance, within a factor of 5
+    return np.clip(0.9 * (tolerance / max(error, 1e-12)) ** (1.0 / (order + 1)), 0.2, 5.0)
+
+
+def integrate_adaptive(step, order, s, a, dt, substeps, tolerance):
+    """ NumPy version of the error-controlled integration in integrate. """
+    t, h, h_min = 0.0, dt / substeps, dt / config.INTEGRATOR_MAX_SUBSTEPS
+    while dt - t > 1e-6 * dt:
+        h = min(h, dt - t)
+        s_next, error = step_doubling(step, order, s, a, h)
+        error = np.max(np.abs(error)) if np.all(np.isfinite(error)) else np.inf
+        if error <= tolerance or h <= h_min:
+            s, t = s_next, t + h
+        h = max(h * step_factor(error, tolerance, order), h_min)
+    return s
+
+
+def integrate_adaptive_tf(step, order, s, a, dt, substeps, tolerance):
+    """ TensorFlow version of integrate_adaptive, as a tf.while_loop. """
+    h_min = dt / config.INTEGRATOR_MAX_SUBSTEPS
+
+    def cond(t, h, s):
+        return dt - t > 1e-6 * dt
+
+    def body(t, h, s):
+        h = tf.minimum(h, dt - t)
+        s_next, error = step_doubling(step, order, s, a, tf.cast(h, s.dtype))
+        error = tf.cast(tf.stop_gradient(tf.reduce_max(tf.abs(error))), tf.float64)
+        error = tf.where(tf.math.is_finite(error), error, tf.constant(np.inf, tf.float64))
+        accept = tf.logical_or(error <= tolerance, h <= h_min)
+        s = tf.cond(accept, lambda: s_next, lambda: s)
+        t = tf.where(accept, t + h, t)
+        factor = tf.clip_by_value(0.9 * (tolerance / tf.maximum(error, 1e-12)) ** (
+            1.0 / (order + 1)), 0.2, 5.0)
+        return t, tf.maximum(h * factor, h_min), s
+
+    _, _, s = tf.while_loop(cond, body, [
+        tf.constant(0.0, tf.float64), tf.constant(dt / substeps, tf.float64), s])
+    return s
+
+
+def integrate(s, a, dt=config.TIME_STEP, method=None, substeps=None, tolerance=None):
+    """ Advances the state over one control period with the action held fixed.
+
+    The period is split into substeps steps of the chosen integrator, and the
+    action is held over all of them (zero-order hold), so a finer or higher
+    order integration costs no extra evaluations of the controller. Works on
+    NumPy arrays as well as on tensors.
+
+    With a positive tolerance the steps are instead chosen by step doubling:
+    each step is compared with two of half its length, rejected and retried
+    shorter while the largest difference over the batch exceeds the tolerance,
+    and the next step is grown or shrunk from it. substeps then only sets the
+    first step, and no step is shorter than dt / config.INTEGRATOR_MAX_SUBSTEPS.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state.
+        a (N, 2) or (B, N, 2): The acceleration taken by each agent.
+        dt (float): The control period.
+        method (str): A name in INTEGRATORS, config.INTEGRATOR if None.
+        substeps (int): The number of steps per period, config.INTEGRATOR_SUBSTEPS if None.
+        tolerance (float): The local error allowed per step, 0 for fixed steps,
+            config.INTEGRATOR_TOLERANCE if None.
+    Returns:
+        s_next (N, 4) or (B, N, 4): The state after dt.
+    """
+    method = config.INTEGRATOR if method is None else method
+    substeps = config.INTEGRATOR_SUBSTEPS if substeps is None else substeps
+    tolerance = config.INTEGRATOR_TOLERANCE if tolerance is None else tolerance
+    if method not in INTEGRATORS:
+        raise ValueError('Unknown integrator {}, expected one of {}.'.format(
+            method, sorted(INTEGRATORS)))
+    is_tensor = tf.is_tensor(s) or tf.is_tensor(a)
+    if is_tensor:
+        f, concat = dynamics, tf.concat
+    else:
+        f, concat = dynamics_np, np.concatenate
+    step = lambda s, a, h: INTEGRATORS[method](f, concat, s, a, h)
+    if tolerance > 0 and is_tensor:
+        return integrate_adaptive_tf(step, INTEGRATOR_ORDERS[method], tf.convert_to_tensor(s),
+                                     a, dt, substeps, tolerance)
+    if tolerance > 0:
+        return integrate_adaptive(step, INTEGRATOR_ORDERS[method], s, a, dt, substeps, tolerance)
+    for _ in range(substeps):
+        s = step(s, a, dt / substeps)
+    return s
+
+
+def action_sensitivity(dt=config.TIME_STEP, method=None, substeps=None):
+    """ Returns the change of the next state per unit of action.
+
+    The dynamics are linear and every integrator is too, so integrate(s, a)
+    equals integrate(s, 0) plus this gain times a, channel by channel.
+
+    Returns:
+        sensitivity (4,): The gain on the position and velocity channels.
+    """
+    return integrate(np.zeros((1, 4)), np.ones((1, 2)), dt, method, substeps)[0]
+
+
+def loss_barrier(h, s, r, ttc, neighbors=None, eps=[1e-3, 0]):
     """ Build the loss function for the control barrier functions.
 
     Args:
@@ -229,12 +472,17 @@ def loss_barrier(h, s, r, ttc, indices=None, eps=[1e-3, 0]):
         s (N, 4): The current state of N agents.
         r (float): The radius of the safe regions.
         ttc (float): The threshold of time to collision.
+        neighbors (Neighbors): The neighbors of each agent, gathered at s.
     """
 
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
     h_reshape = tf.reshape(h, [-1])
-    dang_mask = ttc_dangerous_mask(s, r=r, ttc=ttc, indices=indices)
+    dang_mask = ttc_dangerous_mask(s, r=r, ttc=ttc, neighbors=neighbors)
     dang_mask_reshape = tf.reshape(dang_mask, [-1])
-    safe_mask_reshape = tf.logical_not(dang_mask_reshape)
+    valid_reshape = tf.reshape(tf.greater_equal(neighbors.indices, 0), [-1])
+    safe_mask_reshape = tf.logical_and(
+        tf.logical_not(dang_mask_reshape), valid_reshape)
 
     dang_h = tf.boolean_mask(h_reshape, dang_mask_reshape)
     safe_h = tf.boolean_mask(h_reshape, safe_mask_reshape)
@@ -260,19 +508,22 @@ def loss_barrier(h, s, r, ttc, indices=None, eps=[1e-3, 0]):
     return loss_dang, loss_safe, acc_dang, acc_safe
 
 
-def loss_derivatives(s, a, h, x, r, ttc, alpha, indices=None, eps=[1e-3, 0]):
-    dsdt = dynamics(s, a)
-    s_next = s + dsdt * config.TIME_STEP
+def loss_derivatives(s, a, h, r, ttc, alpha, neighbors=None, eps=[1e-3, 0]):
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
+    s_next = integrate(s, a)
 
-    x_next = tf.expand_dims(s_next, 1) - tf.expand_dims(s_next, 0)
-    h_next, mask_next, _ = network_cbf(x=x_next, r=config.DIST_MIN_THRES, indices=indices)
+    h_next, mask_next, _ = network_cbf(
+        s=s_next, r=config.DIST_MIN_THRES, neighbors=update_neighbors(neighbors, s_next))
 
     deriv = h_next - h + config.TIME_STEP * alpha * h
 
     deriv_reshape = tf.reshape(deriv, [-1])
-    dang_mask = ttc_dangerous_mask(s=s, r=r, ttc=ttc, indices=indices)
+    dang_mask = ttc_dangerous_mask(s=s, r=r, ttc=ttc, neighbors=neighbors)
     dang_mask_reshape = tf.reshape(dang_mask, [-1])
-    safe_mask_reshape = tf.logical_not(dang_mask_reshape)
+    valid_reshape = tf.reshape(tf.greater_equal(neighbors.indices, 0), [-1])
+    safe_mask_reshape = tf.logical_and(
+        tf.logical_not(dang_mask_reshape), valid_reshape)
 
     dang_deriv = tf.boolean_mask(deriv_reshape, dang_mask_reshape)
     safe_deriv = tf.boolean_mask(deriv_reshape, safe_mask_reshape)
@@ -297,19 +548,27 @@ def loss_derivatives(s, a, h, x, r, ttc, alpha, indices=None, eps=[1e-3, 0]):
 
     return loss_dang_deriv, loss_safe_deriv, acc_dang_deriv, acc_safe_deriv
 
+# the gain of the LQR baseline, acting on the state relative to the goal
+LQR_GAIN = np.eye(2, 4) + np.eye(2, 4, k=2) * np.sqrt(3)
+
+
 def loss_actions(s, g, a, desired_formation, r, ttc):
-    # Compute formation error
-    formation_error = tf.reduce_mean(tf.norm(s[:, :2] - desired_formation, axis=1))
+    # Compute formation error of the formation agents, relative to the leader
+    desired_formation = tf.cast(desired_formation, tf.float32)
+    num_formation = tf.shape(desired_formation)[0]
+    formation_dist = tf.norm(
+        s[..., :num_formation, :2] - (s[..., :1, :2] + desired_formation), axis=-1)
+    formation_error = tf.reduce_sum(formation_dist) / tf.maximum(
+        tf.cast(tf.size(formation_dist), tf.float32), 1.0)
     
     # Reference action (LQR-like controller)
-    state_gain = -tf.constant(
-        np.eye(2, 4) + np.eye(2, 4, k=2) * np.sqrt(3), dtype=tf.float32)
-    s_ref = tf.concat([s[:, :2] - g, s[:, 2:]], axis=1)
-    action_ref = tf.linalg.matmul(s_ref, state_gain, False, True)
+    state_gain = -tf.constant(LQR_GAIN, dtype=tf.float32)
+    s_ref = tf.concat([s[..., :2] - g, s[..., 2:]], axis=-1)
+    action_ref = tf.tensordot(s_ref, tf.transpose(state_gain), axes=1)
     
     # Compute the difference between the network's action and the reference action
-    action_ref_norm = tf.reduce_sum(tf.square(action_ref), axis=1)
-    action_net_norm = tf.reduce_sum(tf.square(a), axis=1)
+    action_ref_norm = tf.reduce_sum(tf.square(action_ref), axis=-1)
+    action_net_norm = tf.reduce_sum(tf.square(a), axis=-1)
     norm_diff = tf.abs(action_net_norm - action_ref_norm)
     
     # Total loss: action difference + formation error
@@ -317,12 +576,213 @@ def loss_actions(s, g, a, desired_formation, r, ttc):
     return loss
 
 
-def statics(s, a, h, alpha, indices=None):
-    dsdt = dynamics(s, a)
-    s_next = s + dsdt * config.TIME_STEP
+def loss_formation(s, desired_formation, neighbors=None):
+    """ Penalizes the deviation of neighboring agents from their desired offsets.
+
+    Only the TOP_K neighbors of each agent enter the loss, so memory and the
+    gradient, which flows back through a gather, grow with N * TOP_K rather
+    than N^2.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        desired_formation (N, 2): The desired offset of each agent from the
+            leader, from leader_formation, shared across the batch.
+        neighbors (Neighbors): The neighbors of each agent, searched if None.
+    Returns:
+        loss (float): The mean squared error of the relative positions over
+            every observed pair.
+    """
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
+    desired_formation = tf.cast(desired_formation, tf.float32)
+    valid = tf.cast(tf.expand_dims(neighbors.indices >= 0, -1), tf.float32)
+    desired_relative = tf.expand_dims(desired_formation, -2) - tf.gather(
+        desired_formation, tf.maximum(neighbors.indices, 0))
+    error = tf.square(neighbors.x[..., :2] - desired_relative) * valid
+    return tf.reduce_sum(error) / tf.math.maximum(2.0 * tf.reduce_sum(valid), 1.0)
+
+
+def refine_action_gradient(s, a, h, mask, neighbors, alpha=config.ALPHA_CBF):
+    """ Corrects the action by gradient steps on the CBF condition.
+
+    Each agent stays active while its violation is above REFINE_TOLERANCE and
+    still changes by more than a fraction REFINE_MIN_CHANGE per step. The step
+    descends the violation of the active agents only, so a converged or stalled
+    agent keeps its action unless an active neighbor needs it to move, and the
+    loop stops once no agent is active, or after REFINE_LOOPS steps. The
+    agent's own slot is left out of the violation, since no action can change
+    it.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        a (N, 2) or (B, N, 2): The nominal action.
+        h (N, k, 1) or (B, N, k, 1): The CBF at s.
+        mask (N, k, 1) or (B, N, k, 1): The observation mask at s.
+        neighbors (Neighbors): The neighbors of each agent, gathered at s.
+        alpha (float): The class-K coefficient of the CBF condition.
+    Returns:
+        a_res (N, 2) or (B, N, 2): The correction to add to a.
+        loop_count (int): The number of iterations used.
+    """
+    def opt_body(a_res, loop_count, active, last_error):
+        # a loop of updating a_res
+        # compute s_next under a + a_res
+        s_next = integrate(s, a + a_res)
+        h_next, mask_next, _ = network_cbf(
+            s=s_next, r=config.DIST_MIN_THRES,
+            neighbors=update_neighbors(neighbors, s_next))
+        # deriv should be >= 0. if not, we update a_res by gradient descent
+        deriv = h_next - h + config.TIME_STEP * alpha * h
+        deriv = deriv * mask * mask_next * (1 - neighbors.eye)
+        error = tf.reduce_sum(tf.math.maximum(-deriv, 0), axis=-2)
+        # an agent stops once its constraints hold or its violation stalls
+        stalled = tf.less_equal(tf.abs(last_error - error), config.REFINE_MIN_CHANGE * error)
+        active = tf.logical_and(active, tf.logical_and(
+            tf.greater(error, config.REFINE_TOLERANCE), tf.logical_not(stalled)))
+        # compute the gradient to update a_res. it also moves the neighbors
+        # an active agent is violating its constraints with
+        error_gradient = tf.gradients(error * tf.cast(active, tf.float32), a_res)[0]
+        a_res = a_res - config.REFINE_LEARNING_RATE * error_gradient
+        loop_count = loop_count + 1
+        return a_res, loop_count, active, error
+
+    def opt_cond(a_res, loop_count, active, last_error):
+        # update u_res for at most REFINE_LOOPS, or while any agent is active
+        cond = tf.logical_and(
+            tf.less(loop_count, config.REFINE_LOOPS),
+            tf.reduce_any(active))
+        return cond
+
+    # the loop starts from zero tensors rather than variables, so the graph
+    # holds no state of its own and can be frozen into constants
+    error_shape = tf.concat([tf.shape(a)[:-1], [1]], axis=0)
+    a_res, loop_count, _, _ = tf.while_loop(
+        opt_cond, opt_body, [tf.zeros_like(a), tf.constant(0),
+                             tf.ones(error_shape, tf.bool), tf.fill(error_shape, np.inf)])
+    return a_res, loop_count
+
+
+def refine_action_qp(s, a, h, mask, neighbors, alpha=config.ALPHA_CBF):
+    """ Corrects the action by a linearized safety filter instead of gradient descent.
+
+    The action enters x_next linearly, through the relative position and
+    velocity scaled by action_sensitivity, so h_next is linearized around
+    a + a_res: moving agents i and j by a_res_i and a_res_j changes deriv_ij
+    by g_ij . (a_res_i - a_res_j), with g_ij the CBF gradient on those
+    channels times their sensitivity. The agents then solve the joint QP
+
+        min sum_i ||a_res_i||^2  s.t.  deriv_ij + g_ij . (a_res_i - a_res_j) >= 0  for all i, j,
+
+    with deriv_ij shifted to the linearization point, by projected ascent with
+    Nesterov momentum on its dual. The ascent stops once the linearized
+    violation of every agent is within REFINE_TOLERANCE, or the correction
+    moves by less than QP_TOLERANCE, or after QP_ITERATIONS steps. The filter
+    is linearized again around the new action, up to QP_LINEARIZATIONS times,
+    until the CBF condition itself holds within REFINE_TOLERANCE. Nothing is
+    solved when it already holds at a.
 
-    x_next = tf.expand_dims(s_next, 1) - tf.expand_dims(s_next, 0)
-    h_next, mask_next, _ = network_cbf(x=x_next, r=config.DIST_MIN_THRES, indices=indices)
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        a (N, 2) or (B, N, 2): The nominal action.
+        h (N, k, 1) or (B, N, k, 1): The CBF at s.
+        mask (N, k, 1) or (B, N, k, 1): The observation mask at s.
+        neighbors (Neighbors): The neighbors of each agent, gathered at s.
+        alpha (float): The class-K coefficient of the CBF condition.
+    Returns:
+        a_res (N, 2) or (B, N, 2): The correction to add to a.
+        loop_count (int): The number of QP iterations used, over all linearizations.
+    """
+    sensitivity = action_sensitivity().astype(np.float32)
+
+    # each constraint ij moves agent i along +g_ij and its neighbor j along -g_ij
+    n = tf.shape(a)[-2]
+    rows = tf.reshape(tf.range(tf.size(a) // 2), tf.shape(a)[:-1])
+    columns = tf.maximum(neighbors.indices, 0) + tf.expand_dims(rows // n * n, -1)
+
+    def scatter(value):
+        # sums value (..., N, k, C) onto the neighbor of each slot, giving (..., N, C)
+        c = value.get_shape().as_list()[-1]
+        total = tf.math.unsorted_segment_sum(
+            tf.reshape(value, [-1, c]), tf.reshape(columns, [-1]), tf.size(a) // 2)
+        return tf.reshape(total, tf.concat([tf.shape(a)[:-1], [c]], axis=0))
+
+    def gather(value):
+        c = value.get_shape().as_list()[-1]
+        return tf.gather(tf.reshape(value, [-1, c]), columns)
+
+    def solve(a_res, loop_count, deriv, h_next, neighbors_next, active):
+        grad = tf.gradients(h_next, neighbors_next.x)[0]
+        g = (grad[..., :2] * sensitivity[:2] + grad[..., 2:] * sensitivity[2:]) * active
+
+        def change(a_qp):
+            return tf.reduce_sum(g * (tf.expand_dims(a_qp, -2) - gather(a_qp)), axis=-1, keepdims=True)
+
+        # the constraints linearized around a + a_res, on the whole correction
+        bound = deriv - change(a_res)
+        norm = tf.reduce_sum(tf.square(g), axis=-1, keepdims=True)
+        load = tf.reduce_sum(norm, axis=-2) + scatter(norm)
+        step = 1.0 / (tf.expand_dims(load, -2) + gather(load) + 1e-8)
+
+        def violation(a_qp):
+            return tf.math.maximum(-bound - change(a_qp), 0)
+
+        def correct(dual):
+            return tf.reduce_sum(dual * g, axis=-2) - scatter(dual * g)
+
+        def qp_body(dual, dual_last, a_qp, a_last, qp_count, max_change):
+            # projected ascent on the dual with Nesterov momentum. The
+            # correction is linear in the dual, so it is carried along
+            momentum = tf.cast(qp_count, tf.float32) / tf.cast(qp_count + 3, tf.float32)
+            dual_ahead = dual + momentum * (dual - dual_last)
+            a_ahead = a_qp + momentum * (a_qp - a_last)
+            dual_next = tf.math.maximum(dual_ahead + step * violation(a_ahead), 0)
+            a_next = correct(dual_next)
+            return (dual_next, dual, a_next, a_qp, qp_count + 1,
+                    tf.reduce_max(tf.abs(a_next - a_qp)))
+
+        def qp_cond(dual, dual_last, a_qp, a_last, qp_count, max_change):
+            error = tf.reduce_sum(violation(a_qp), axis=-2)
+            return tf.logical_and(
+                tf.logical_and(tf.less(qp_count, config.QP_ITERATIONS),
+                               tf.greater(max_change, config.QP_TOLERANCE)),
+                tf.greater(tf.reduce_max(error), config.REFINE_TOLERANCE))
+
+        zeros = tf.zeros_like(deriv)
+        _, _, a_res, _, qp_count, _ = tf.while_loop(qp_cond, qp_body, [
+            zeros, zeros, tf.zeros_like(a), tf.zeros_like(a), tf.constant(0), tf.constant(np.inf)])
+        return a_res, loop_count + qp_count
+
+    def outer_body(a_res, loop_count, linearizations, converged):
+        s_next = integrate(s, a + a_res)
+        neighbors_next = update_neighbors(neighbors, s_next)
+        h_next, mask_next, _ = network_cbf(
+            s=s_next, r=config.DIST_MIN_THRES, neighbors=neighbors_next)
+        # the agent's own slot does not move with its action
+        active = mask * mask_next * (1 - neighbors.eye)
+        deriv = (h_next - h + config.TIME_STEP * alpha * h) * active
+        error = tf.reduce_sum(tf.math.maximum(-deriv, 0), axis=-2)
+        converged = tf.less_equal(tf.reduce_max(error), config.REFINE_TOLERANCE)
+        a_res, loop_count = tf.cond(
+            converged, lambda: (a_res, loop_count),
+            lambda: solve(a_res, loop_count, deriv, h_next, neighbors_next, active))
+        return a_res, loop_count, linearizations + 1, converged
+
+    def outer_cond(a_res, loop_count, linearizations, converged):
+        return tf.logical_and(tf.less(linearizations, config.QP_LINEARIZATIONS),
+                              tf.logical_not(converged))
+
+    a_res, loop_count, _, _ = tf.while_loop(
+        outer_cond, outer_body, [tf.zeros_like(a), tf.constant(0), tf.constant(0), tf.constant(False)])
+    return a_res, loop_count
+
+
+def statics(s, a, h, alpha, neighbors=None):
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
+    s_next = integrate(s, a)
+
+    h_next, mask_next, _ = network_cbf(
+        s=s_next, r=config.DIST_MIN_THRES, neighbors=update_neighbors(neighbors, s_next))
 
     deriv = h_next - h + config.TIME_STEP * alpha * h
 
@@ -333,12 +793,11 @@ def statics(s, a, h, alpha, indices=None):
     return mean_deriv, std_deriv, prob_neg
 
 
-def ttc_dangerous_mask(s, r, ttc, indices=None):
-    s_diff = tf.expand_dims(s, 1) - tf.expand_dims(s, 0)
-    s_diff = tf.concat(
-        [s_diff, tf.expand_dims(tf.eye(tf.shape(s)[0]), 2)], axis=2)
-    s_diff, _ = remove_distant_agents(s_diff, config.TOP_K, indices)
-    x, y, vx, vy, eye = tf.split(s_diff, 5, axis=2)
+def ttc_dangerous_mask(s, r, ttc, neighbors=None):
+    if neighbors is None:
+        neighbors = build_neighbors(s, config.TOP_K)
+    eye = neighbors.eye
+    x, y, vx, vy = tf.split(neighbors.x, 4, axis=-1)
     x = x + eye
     y = y + eye
     alpha = vx ** 2 + vy ** 2
@@ -359,10 +818,16 @@ def ttc_dangerous_mask(s, r, ttc, indices=None):
 
 
 def ttc_dangerous_mask_np(s, r, ttc):
-    s_diff = np.expand_dims(s, 1) - np.expand_dims(s, 0)
-    x, y, vx, vy = np.split(s_diff, 4, axis=2)
-    x = x + np.expand_dims(np.eye(np.shape(s)[0]), 2)
-    y = y + np.expand_dims(np.eye(np.shape(s)[0]), 2)
+    s_diff = np.expand_dims(s, -2) - np.expand_dims(s, -3)
+    x, y, vx, vy = np.split(s_diff, 4, axis=-1)
+    x = x + np.expand_dims(np.eye(np.shape(s)[-2]), -1)
+    y = y + np.expand_dims(np.eye(np.shape(s)[-2]), -1)
+    return ttc_dangerous_np(x, y, vx, vy, r, ttc)
+
+
+def ttc_dangerous_np(x, y, vx, vy, r, ttc):
+    """ Whether two agents with relative position (x, y) and relative velocity
+    (vx, vy) are closer than r, or will be within ttc at constant velocity. """
     alpha = vx ** 2 + vy ** 2
     beta = 2 * (x * vx + y * vy)
     gamma = x ** 2 + y ** 2 - r ** 2
@@ -380,19 +845,353 @@ def ttc_dangerous_mask_np(s, r, ttc):
     return ttc_dangerous
 
 
-def remove_distant_agents(x, k, indices=None):
-    n, _, c = x.get_shape().as_list()
-    if n <= k:
-        return x, False
-    d_norm = tf.sqrt(tf.reduce_sum(tf.square(x[:, :, :2]) + 1e-6, axis=2))
-    if indices is not None:
-        x = tf.reshape(tf.gather_nd(x, indices), [n, k, c])
-        return x, indices
-    _, indices = tf.nn.top_k(-d_norm, k=k)
-    row_indices = tf.expand_dims(
-        tf.range(tf.shape(indices)[0]), 1) * tf.ones_like(indices)
-    row_indices = tf.reshape(row_indices, [-1, 1])
-    column_indices = tf.reshape(indices, [-1, 1])
-    indices = tf.concat([row_indices, column_indices], axis=1)
-    x = tf.reshape(tf.gather_nd(x, indices), [n, k, c])
-    return x, indices
+def ttc_dangerous_count_np(s, r, ttc):
+    """ Counts the agents each agent is in danger with, without the dense
+    (N, N) pairwise arrays of ttc_dangerous_mask_np.
+
+    Two agents with speeds v_i and v_j can only get within r of each other in
+    ttc if they are now closer than r + (v_i + v_j) * ttc, at most the larger
+    of r + 2 * v_i * ttc and r + 2 * v_j * ttc. Each agent searches its own
+    radius by grid hashing, so a few fast agents do not widen the search of
+    all the others, and only the pairs found are tested.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        r (float): The safe distance.
+        ttc (float): The time to collision horizon.
+    Returns:
+        count (N, 1) or (B, N, 1): The number of dangerous pairs of each agent,
+            equal to np.sum(ttc_dangerous_mask_np(s, r, ttc), axis=-2).
+    """
+    flat = np.reshape(s, (-1, 4))
+    speed = np.linalg.norm(s[..., 2:], axis=-1)
+    i, j = neighbor_pairs_np(s[..., :2], r + 2 * speed * ttc)
+    x, y, vx, vy = np.split(flat[i] - flat[j], 4, axis=-1)
+    dangerous = np.squeeze(ttc_dangerous_np(x, y, vx, vy, r, ttc), -1)
+    count = np.bincount(i[dangerous], minlength=flat.shape[0])
+    return np.reshape(count, s.shape[:-1] + (1,))
+
+
+def neighbor_pairs_np(p, radius):
+    """ Finds the candidate pairs of agents within radius by uniform grid hashing.
+
+    The cells have the median radius as their side, and each agent searches
+    the rows of cells within its own radius, so a pair closer than the larger
+    of its two radii is found by the agent with that radius. A single agent
+    with a large radius thus widens its own search only, not everyone's.
+    Scenarios of a batch never pair.
+
+    Args:
+        p (N, 2) or (B, N, 2): The positions of N agents.
+        radius (float or (N,) or (B, N)): The search radius of each agent.
+    Returns:
+        i, j (P,): Indices into the flattened agents of ordered pairs i != j,
+            both ways round, a superset of the pairs within the larger radius.
+    """
+    n = p.shape[-2]
+    p = np.reshape(p, (-1, n, 2)).astype(np.float64)
+    radius = np.reshape(np.broadcast_to(radius, p.shape[:-1]), -1).astype(np.float64)
+    size = np.median(radius)
+    cell = np.floor(p / size).astype(np.int64)
+    cell = cell - np.min(cell, axis=(0, 1))
+    height = np.max(cell[:, :, 0]) + 1
+    width = np.max(cell[:, :, 1]) + 1
+    base = np.reshape(np.repeat(np.arange(p.shape[0]) * height, n), -1)
+    row = base + np.reshape(cell[:, :, 0], -1)
+    col = np.reshape(cell[:, :, 1], -1)
+    key = row * width + col
+    m = key.shape[0]
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    # the cells within an agent's radius, clipped to its own scenario
+    reach = np.ceil(radius / size).astype(np.int64)
+    row_low = np.maximum(row - reach, base)
+    num_rows = np.minimum(row + reach, base + height - 1) - row_low + 1
+    col_low = np.maximum(col - reach, 0)
+    col_high = np.minimum(col + reach, width - 1)
+    # each row of cells is one contiguous range of keys
+    agent = np.repeat(np.arange(m), num_rows)
+    rows = row_low[agent] + np.arange(len(agent)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+    start = np.searchsorted(sorted_key, rows * width + col_low[agent], side='left')
+    count = np.searchsorted(sorted_key, rows * width + col_high[agent], side='right') - start
+
+    # expand every (agent, row) range of the sorted agents into pairs
+    i = np.repeat(agent, count)
+    first = np.cumsum(count) - count
+    j = order[np.arange(np.sum(count)) - np.repeat(first - start, count)]
+    # a pair is kept by the agent with the larger radius, or by both if equal,
+    # and the other way round is added for the former
+    keep = np.logical_and(i != j, radius[j] <= radius[i])
+    larger = np.logical_and(keep, radius[j] < radius[i])
+    return np.concatenate([i[keep], j[larger]]), np.concatenate([j[keep], i[larger]])
+
+
+def lqr_baseline_np(s, g, steps=config.INNER_LOOPS, stop_dist=config.DIST_MIN_CHECK, bounds=None):
+    """ Simulates the LQR baseline on a batch of scenarios at once.
+
+    A scenario stops once its agents are on average within stop_dist of their
+    goals, and keeps its final state while the others go on.
+
+    Args:
+        s (N, 4) or (B, N, 4): The initial states.
+        g (N, 2) or (B, N, 2): The goals.
+        steps (int): The maximum number of steps.
+        stop_dist (float): The mean distance to the goals that ends a scenario.
+        bounds (tuple): The (low, high) positions are clipped to, if given.
+    Returns:
+        trajectory (T, N, 4) or (T, B, N, 4): The states after each step.
+        safety_ratios (T, N, 1) or (T, B, N, 1): The fraction of agents each
+            agent is safe with after each step.
+        num_steps (int) or (B,): The number of steps each scenario ran.
+    """
+    shape = np.shape(s)
+    n = shape[-2]
+    s = np.reshape(np.copy(s), (-1, n, 4))
+    g = np.reshape(g, (-1, n, 2))
+    active = np.ones(s.shape[0], dtype=bool)
+    num_steps = np.zeros(s.shape[0], dtype=np.int64)
+    trajectory, safety_ratios = [], []
+    for i in range(steps):
+        if not np.any(active):
+            break
+        s_ref = np.concatenate([s[..., :2] - g, s[..., 2:]], axis=-1)
+        a = -np.matmul(s_ref, LQR_GAIN.T)
+        s_next = integrate(s, a).astype(s.dtype)
+        if bounds is not None:
+            s_next[..., :2] = np.clip(s_next[..., :2], *bounds)
+        s = np.where(active[:, None, None], s_next, s)
+        trajectory.append(s)
+        safety_ratios.append(1 - ttc_dangerous_count_np(
+            s, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK) / n)
+        num_steps += active
+        active &= np.mean(np.linalg.norm(s[..., :2] - g, axis=-1), axis=-1) >= stop_dist
+    trajectory = np.reshape(np.stack(trajectory), (-1,) + shape)
+    safety_ratios = np.reshape(np.stack(safety_ratios), (-1,) + shape[:-1] + (1,))
+    return trajectory, safety_ratios, num_steps.reshape(shape[:-2])
+
+
+def project_formation(s, num_formation, radius=0.5, radius_min=0.4, radius_max=0.6,
+                      dist_min=config.DIST_MIN_CHECK, push=0.1, leader_idx=0):
+    """ Projects the followers of a formation back onto a ring around the leader.
+
+    The followers are corrected one after another, in index order, as by the
+    original loop of evaluate. A follower closer than radius_min or farther
+    than radius_max is put at that bound, and any other follower at radius.
+    It is then pushed away by push from each other follower, in index order,
+    that is closer than dist_min to its current position, so the followers
+    before it are seen at their corrected positions and those after it at
+    their positions in s. The scenarios of a batch are corrected together,
+    and each follower only takes one vectorized step per push.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents. The first
+            num_formation agents are the formation, led by agent leader_idx.
+        num_formation (int): The number of agents in the formation.
+    Returns:
+        s (N, 4) or (B, N, 4): A copy of s with the followers moved.
+    """
+    s = np.array(s)
+    position = s[..., :num_formation, :2]
+    leader_position = position[..., leader_idx:leader_idx + 1, :]
+    direction = position - leader_position
+    distance = np.linalg.norm(direction, axis=-1, keepdims=True)
+    target = np.where(distance < radius_min, radius_min,
+                      np.where(distance > radius_max, radius_max, radius))
+    on_ring = leader_position + target * direction / np.maximum(distance, 1e-8)
+
+    order = np.arange(num_formation)
+    followers = order != leader_idx
+    for j in order[followers]:
+        current = on_ring[..., j, :]
+        # the index from which the next push is searched, per scenario
+        start = np.zeros(current.shape[:-1], dtype=np.int64)
+        while True:
+            diff = np.expand_dims(current, -2) - position
+            dist = np.linalg.norm(diff, axis=-1)
+            close = (dist < dist_min) & followers & (order != j) & (order >= start[..., None])
+            found = np.any(close, axis=-1)
+            if not np.any(found):
+                break
+            k = np.expand_dims(np.argmax(close, axis=-1), -1)
+            away = np.take_along_axis(diff, k[..., None], axis=-2)[..., 0, :] / np.maximum(
+                np.take_along_axis(dist, k, axis=-1), 1e-8)
+            current = current + push * away * found[..., None]
+            start = np.where(found, k[..., 0] + 1, num_formation)
+        position[..., j, :] = current
+    return s
+
+
+def neighbor_indices(s, k, r=config.OBS_RADIUS, levels=config.NEIGHBOR_LEVELS):
+    """ Selects the k nearest neighbors of each agent by multi-level grid hashing.
+
+    At each level l < levels, agents are bucketed into square cells of side
+    r / 2^(l + 1). Each agent ranks the agents in the 5x5 block of cells around
+    it at the finest level whose own cell still holds k agents, or at level 0
+    if none does. The block reaches two cells away, which covers r at level 0
+    and, at a finer level, the diagonal of the own cell, beyond which none of
+    the k nearest can lie, so the selection is exact.
+
+    Candidates are enumerated agent by agent instead of being padded to the
+    fullest cell, so the work is the sum of the block occupancies. Inside a
+    dense cluster the block shrinks with the density and holds O(k) agents,
+    so the search stays O(N * k) rather than growing with the cluster size.
+    Scenarios in a batch are hashed into disjoint cells, so agents never see
+    neighbors from another scenario.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        k (int): The number of neighbors to select.
+        r (float): The observation radius.
+        levels (int): The number of grid levels.
+    Returns:
+        indices (N, k) or (B, N, k): The neighbor indices within the scenario,
+            sorted by distance and including the agent itself, and -1 in
+            slots with no agent within r.
+    """
+    n = tf.shape(s)[-2]
+    p = tf.reshape(tf.stop_gradient(s[..., :2]), [-1, n, 2])
+    batch = tf.expand_dims(tf.range(tf.shape(p, out_type=tf.int64)[0]), 1)
+    # the cells of every level, with a margin of two cells so that no block
+    # wraps into the next row or scenario, and the keys of each level offset
+    # into a range of their own
+    keys, cells, widths, offset = [], [], [], tf.constant(0, tf.int64)
+    for level in range(levels):
+        cell = tf.cast(tf.floor(p / (r / 2 ** (level + 1))), tf.int64)
+        cell = cell - tf.reduce_min(cell, axis=[0, 1]) + 2
+        height = tf.reduce_max(cell[:, :, 0]) + 3
+        width = tf.reduce_max(cell[:, :, 1]) + 3
+        keys.append(tf.reshape(offset + (batch * height + cell[:, :, 0]) * width + cell[:, :, 1], [-1]))
+        cells.append(tf.reshape(cell, [-1, 2]))
+        widths.append(width)
+        offset = offset + tf.shape(p, out_type=tf.int64)[0] * height * width
+    p = tf.reshape(p, [-1, 2])
+    m = tf.shape(p)[0]
+    keys = tf.stack(keys)
+    order = tf.argsort(tf.reshape(keys, [-1]), stable=True)
+    sorted_key = tf.gather(tf.reshape(keys, [-1]), order)
+
+    # the cells are nested, so the own cell holds k agents up to some level
+    own_count = tf.reshape(
+        tf.searchsorted(sorted_key, tf.reshape(keys, [-1]), side='right') -
+        tf.searchsorted(sorted_key, tf.reshape(keys, [-1]), side='left'), [levels, m])
+    level = tf.reduce_sum(tf.cast(own_count[1:] >= k, tf.int32), axis=0)
+    key = tf.gather_nd(keys, tf.stack([level, tf.range(m)], axis=1))
+    width = tf.gather(tf.stack(widths), level)
+
+    offset = tf.range(-2, 3, dtype=tf.int64)
+    offset = tf.reshape(tf.expand_dims(offset, 1) * tf.reshape(width, [-1, 1, 1]) + offset, [m, 25])
+    block_key = tf.reshape(tf.expand_dims(key, 1) + offset, [-1])
+    start = tf.searchsorted(sorted_key, block_key, side='left')
+    count = tf.searchsorted(sorted_key, block_key, side='right') - start
+
+    # expand every (agent, cell) range of the sorted agents into candidates
+    last = tf.cumsum(count)
+    candidate = tf.range(last[-1])
+    block = tf.searchsorted(last, candidate, side='right')
+    row = block // 25
+    column = tf.gather(order, tf.gather(start, block) + candidate - tf.gather(last - count, block)) % m
+    dist = tf.reduce_sum(tf.square(tf.gather(p, row) - tf.gather(p, column)), axis=1)
+    within = tf.less_equal(dist, r ** 2)
+    row, column, dist = [tf.boolean_mask(x, within) for x in [row, column, dist]]
+
+    # rank the candidates of each agent by distance and keep the first k
+    by_dist = tf.argsort(dist, stable=True)
+    row, column = tf.gather(row, by_dist), tf.gather(column, by_dist)
+    by_row = tf.argsort(row, stable=True)
+    row, column = tf.gather(row, by_row), tf.gather(column, by_row)
+    rank = tf.range(tf.size(row)) - tf.gather(tf.searchsorted(row, tf.range(m), side='left'), row)
+    selected = tf.less(rank, k)
+    row, rank, column = [tf.boolean_mask(x, selected) for x in [row, rank, column]]
+    indices = tf.scatter_nd(tf.stack([row, rank], axis=1), column - row // n * n + 1, [m, k]) - 1
+    return tf.reshape(indices, tf.concat([tf.shape(s)[:-1], [k]], axis=0))
+
+
+def gather_neighbors(s, indices, r=config.OBS_RADIUS):
+    """ Gathers the states of the selected neighbors relative to each agent.
+
+    Args:
+        s (N, C) or (B, N, C): The current state of N agents.
+        indices (N, k) or (B, N, k): The neighbor indices from neighbor_indices.
+        r (float): The observation radius.
+    Returns:
+        x (N, k, C) or (B, N, k, C): s_i - s_j for agent i and its neighbor j.
+            Empty slots are placed at distance 2r with zero relative velocity,
+            so they fall outside every observation and safety mask.
+    """
+    n = tf.shape(s)[-2]
+    c = s.get_shape().as_list()[-1]
+    rows = tf.reshape(tf.range(tf.size(s) // c), tf.shape(s)[:-1])
+    columns = tf.maximum(indices, 0) + tf.expand_dims(rows // n * n, -1)
+    x = tf.expand_dims(s, -2) - tf.gather(tf.reshape(s, [-1, c]), columns)
+    valid = tf.cast(tf.expand_dims(tf.greater_equal(indices, 0), -1), tf.float32)
+    far = 2.0 * r * tf.one_hot(0, c)
+    x = x * valid + far * (1 - valid)
+    return x
+
+
+def flatten_neighbors(x):
+    """ Folds any batch dimension of x (..., N, k, C) into the agents, giving
+    the (M, k, C) input expected by the 1x1 convolutions. """
+    return tf.reshape(x, [-1, tf.shape(x)[-2], x.get_shape().as_list()[-1]])
+
+
+def neighbor_eye(indices):
+    """ Marks the slot of each agent's own state, shape (..., N, k, 1). """
+    rows = tf.expand_dims(tf.range(tf.shape(indices)[-2]), 1)
+    eye = tf.cast(tf.equal(indices, rows), tf.float32)
+    return tf.expand_dims(eye, -1)
+
+
+# The neighbor set of one step: indices (..., N, k) from neighbor_indices,
+# relative states x (..., N, k, C) from gather_neighbors and self slots
+# eye (..., N, k, 1) from neighbor_eye.
+Neighbors = collections.namedtuple('Neighbors', ['indices', 'x', 'eye'])
+
+
+def build_neighbors(s, k=config.TOP_K, r=config.OBS_RADIUS):
+    """ Runs the neighbor search once and gathers the relative states.
+
+    Build this once per step and pass it to network_cbf, network_action,
+    loss_barrier, loss_derivatives and ttc_dangerous_mask, so that the pairwise
+    work is not repeated by each of them.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        k (int): The number of neighbors to select.
+        r (float): The observation radius.
+    Returns:
+        neighbors (Neighbors): The neighbors of each agent, gathered at s.
+    """
+    indices = neighbor_indices(s, k, r)
+    return Neighbors(indices=indices,
+                     x=gather_neighbors(s, indices, r),
+                     eye=neighbor_eye(indices))
+
+
+def all_neighbors(s):
+    """ Takes every agent as a neighbor of every agent, itself included.
+
+    For checks that must cover all pairs, such as the safety rate of a
+    rollout, where the TOP_K nearest would miss fast agents further away. The
+    tensors are (N, N), so this is meant for swarms of training size.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+    Returns:
+        neighbors (Neighbors): All N agents as the neighbors of each agent.
+    """
+    n = tf.shape(s)[-2]
+    indices = tf.broadcast_to(tf.range(n), tf.concat([tf.shape(s)[:-1], [n]], axis=0))
+    return Neighbors(indices=indices,
+                     x=gather_neighbors(s, indices),
+                     eye=neighbor_eye(indices))
+
+
+def update_neighbors(neighbors, s, r=config.OBS_RADIUS):
+    """ Re-gathers the relative states at a new state, keeping the same indices.
+
+    Used for the next state s + dsdt * TIME_STEP, where the CBF must be compared
+    pair by pair with its value at the current state.
+    """
+    return neighbors._replace(x=gather_neighbors(s, neighbors.indices, r))
@@ -4,78 +4,107 @@ sys.dont_write_bytecode = True
 import os
 import time
 import argparse
+import subprocess
 import numpy as np
 import tensorflow as tf
-import matplotlib.pyplot as plt
 
 import core
 import config
+import profiling
+import scenario_bank
+import trajectory
 
 import tensorflow as tf
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--num_agents', type=int, required=True)
+    parser.add_argument('--num_agents', type=int, nargs='+', required=True)
     parser.add_argument('--model_path', type=str, default=None)
     parser.add_argument('--vis', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--refine', type=str, default=config.REFINE_MODE, choices=['gradient', 'qp'])
+    parser.add_argument('--diag_every', type=int, default=1)
+    parser.add_argument('--diag_deferred', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--bank', type=str, default=None)
+    parser.add_argument('--record', type=str, default=None)
+    parser.add_argument('--vis_output', type=str, default='vis')
+    parser.add_argument('--vis_format', type=str, default=None, choices=['mp4', 'gif', 'png'])
+    parser.add_argument('--profile', type=int, default=0)
+    parser.add_argument('--trace_steps', type=int, nargs='*', default=[])
+    parser.add_argument('--trace_dir', type=str, default='traces')
     parser.add_argument('--gpu', type=str, default='0')
     args = parser.parse_args()
     return args
 
-def build_evaluation_graph(num_agents):
+def build_control_graph(num_agents=None, batch_size=None, refine=config.REFINE_MODE):
+    """ Builds the s, g -> a_opt path that a deployed controller runs each step.
+
+    With num_agents None the agent dimension is left dynamic, so one graph
+    serves swarms of any size, including fewer agents than TOP_K, whose empty
+    neighbor slots are masked out.
+
+    Returns:
+        s, g: The state and goal placeholders, named 's' and 'g'.
+        formation (M, 2): The desired offsets of the first M agents from the
+            leader, named 'formation'. It defaults to every agent in the
+            configured formation, when the shape can lay them out.
+        a (N, 2) or (B, N, 2): The nominal action of the action network.
+        a_opt (N, 2) or (B, N, 2): The refined action, named 'a_opt'.
+        neighbors (Neighbors): The neighbors of each agent at s.
+        refine_steps (int): The number of refinement iterations, named 'refine_steps'.
+        h (N, k, 1) or (B, N, k, 1): The CBF at s.
+    """
     if tf.is_tensor(num_agents):
-        num_agents = tf.keras.backend.eval(num_agents)  # Evaluate the tensor dynamically
-    else:
+        num_agents = tf.get_static_value(num_agents)  # Resolve the tensor without a session
+    if num_agents is not None:
         num_agents = int(num_agents)  # Ensure it's a Python integer
+    # with a batch_size, batch_size independent scenarios are advanced in lockstep
+    # and every tensor below gets a leading batch dimension
+    batch_shape = [] if batch_size is None else [int(batch_size)]
     
     # s is the state vectors of the agents
-    s = tf.placeholder(tf.float32, [num_agents, 4])
+    s = tf.placeholder(tf.float32, batch_shape + [num_agents, 4], name='s')
     # g is the goal states
-    g = tf.placeholder(tf.float32, [num_agents, 2])
-    # x is difference between the state of each agent and other agents
-    x = tf.expand_dims(s, 1) - tf.expand_dims(s, 0)
-    # h is the CBF value of shape [num_agents, TOP_K, 1], where TOP_K represents
-    # the K nearest agents
-    h, mask, indices = core.network_cbf(x=x, r=config.DIST_MIN_THRES)
-    # a is the control action of each agent, with shape [num_agents, 3]
-    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, indices=indices)
+    g = tf.placeholder(tf.float32, batch_shape + [num_agents, 2], name='g')
+    # formation is the desired formation of the scenario, built once by
+    # core.leader_formation and shared by the action network and the losses
+    try:
+        default_formation = core.leader_formation(core.agent_count(s))
+    except ValueError:
+        # shapes such as 'points' only lay out their own number of agents, and
+        # only the circle a number known at run time, so it has to be fed
+        default_formation = None
+    if default_formation is None:
+        formation = tf.placeholder(tf.float32, [None, 2], name='formation')
+    else:
+        formation = tf.placeholder_with_default(
+            tf.cast(default_formation, tf.float32), [None, 2], name='formation')
+    # neighbors holds the TOP_K nearest agents within the observation radius,
+    # searched once per step and shared by every network and loss below
+    neighbors = core.build_neighbors(s)
+    # h is the CBF value of shape [num_agents, TOP_K, 1]
+    h, mask, _ = core.network_cbf(s=s, r=config.DIST_MIN_THRES, neighbors=neighbors)
+    # a is the control action of each agent, with shape [num_agents, 2]
+    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, neighbors=neighbors, desired_formation=formation)
     # a_res is delta a. when a does not satisfy the CBF conditions, we want to compute
     # a a_res such that a + a_res satisfies the CBF conditions
-    a_res = tf.Variable(tf.zeros_like(a), name='a_res')
-    loop_count = tf.Variable(0, name='loop_count')
-   
-    def opt_body(a_res, loop_count):
-        # a loop of updating a_res
-        # compute s_next under a + a_res
-        dsdt = core.dynamics(s, a + a_res)
-        s_next = s + dsdt * config.TIME_STEP
-        x_next = tf.expand_dims(s_next, 1) - tf.expand_dims(s_next, 0)
-        h_next, mask_next, _ = core.network_cbf(
-            x=x_next, r=config.DIST_MIN_THRES, indices=indices)
-        # deriv should be >= 0. if not, we update a_res by gradient descent
-        deriv = h_next - h + config.TIME_STEP * config.ALPHA_CBF * h
-        deriv = deriv * mask * mask_next
-        error = tf.reduce_sum(tf.math.maximum(-deriv, 0), axis=1)
-        # compute the gradient to update a_res
-        error_gradient = tf.gradients(error, a_res)[0]
-        a_res = a_res - config.REFINE_LEARNING_RATE * error_gradient
-        loop_count = loop_count + 1
-        return a_res, loop_count
-
-    def opt_cond(a_res, loop_count):
-        # update u_res for REFINE_LOOPS
-        cond = tf.less(loop_count, config.REFINE_LOOPS)
-        return cond
-    
-    with tf.control_dependencies([
-        a_res.assign(tf.zeros_like(a)), loop_count.assign(0)]):
-        a_res, _ = tf.while_loop(opt_cond, opt_body, [a_res, loop_count])
-        a_opt = a + a_res
-
-    dsdt = core.dynamics(s, a_opt)
-    s_next = s + dsdt * config.TIME_STEP
-    x_next = tf.expand_dims(s_next, 1) - tf.expand_dims(s_next, 0)
-    h_next, mask_next, _ = core.network_cbf(x=x_next, r=config.DIST_MIN_THRES, indices=indices)
+    if refine == 'qp':
+        # linearize the CBF condition once and solve a per-agent QP
+        a_res, refine_steps = core.refine_action_qp(s=s, a=a, h=h, mask=mask, neighbors=neighbors)
+    else:
+        a_res, refine_steps = core.refine_action_gradient(s=s, a=a, h=h, mask=mask, neighbors=neighbors)
+    a_opt = tf.identity(a + a_res, name='a_opt')
+    refine_steps = tf.identity(refine_steps, name='refine_steps')
+    return s, g, formation, a, a_opt, neighbors, refine_steps, h
+
+
+def build_evaluation_graph(num_agents=None, batch_size=None, refine=config.REFINE_MODE):
+    s, g, formation, a, a_opt, neighbors, refine_steps, h = build_control_graph(num_agents, batch_size, refine)
+
+    s_next = core.integrate(s, a_opt)
+    neighbors_next = core.update_neighbors(neighbors, s_next)
+    h_next, mask_next, _ = core.network_cbf(s=s_next, r=config.DIST_MIN_THRES, neighbors=neighbors_next)
     
     # compute the value of loss functions and the accuracies
     # loss_dang is for h(s) < 0, s in dangerous set
@@ -84,29 +113,44 @@ def build_evaluation_graph(num_agents):
     # acc_safe is the accuracy that h(s) >=0, s in safe set is satisfied
     (loss_dang, loss_safe, acc_dang, acc_safe) = core.loss_barrier(
         h=h_next, s=s_next, r=config.DIST_MIN_THRES, 
-        ttc=config.TIME_TO_COLLISION, eps=[0, 0])
+        ttc=config.TIME_TO_COLLISION, neighbors=neighbors_next, eps=[0, 0])
     # loss_dang_deriv is for doth(s) + alpha h(s) >=0 for s in dangerous set
     # loss_safe_deriv is for doth(s) + alpha h(s) >=0 for s in safe set
     # loss_medium_deriv is for doth(s) + alpha h(s) >=0 for s not in the dangerous
     # or the safe set
     (loss_dang_deriv, loss_safe_deriv, acc_dang_deriv, acc_safe_deriv
-        ) = core.loss_derivatives(s=s_next, a=a_opt, h=h_next, x=x_next, 
-        r=config.DIST_MIN_THRES, ttc=config.TIME_TO_COLLISION, alpha=config.ALPHA_CBF, indices=indices)
-    # the distance between the u_opt and the nominal u
-    
-    # Define desired formation for all agents (including the leader)
-    num_agents = tf.shape(s)[0]
-    radius = 0.1  # Set the desired radius of the circular formation
-    desired_formation = core.define_circular_formation(num_agents, radius)
-
-    loss_action = core.loss_actions(s, g, a, desired_formation, r=config.DIST_MIN_THRES, ttc=config.TIME_TO_COLLISION)
+        ) = core.loss_derivatives(s=s_next, a=a_opt, h=h_next,
+        r=config.DIST_MIN_THRES, ttc=config.TIME_TO_COLLISION, alpha=config.ALPHA_CBF, neighbors=neighbors_next)
+    # the distance between the u_opt and the nominal u, and the error of the
+    # formation agents from the same desired formation the action network uses
+    loss_action = core.loss_actions(s, g, a, formation, r=config.DIST_MIN_THRES, ttc=config.TIME_TO_COLLISION)
 
     loss_list = [loss_dang, loss_safe, loss_dang_deriv, loss_safe_deriv, loss_action]
     acc_list = [acc_dang, acc_safe, acc_dang_deriv, acc_safe_deriv]
 
-    return s, g, a_opt, loss_list, acc_list
+    return s, g, formation, a_opt, loss_list, acc_list, refine_steps, h
     
+def run_diagnostics(sess, s, g, a, acc_list, trajectory):
+    """ Computes the accuracies of stored control steps after the fact.
+
+    Feeding a stores the refined action instead of recomputing it, so only the
+    CBF on the next state and the losses are evaluated.
+
+    Args:
+        trajectory (list): The (s_np, g_np, a_np) of each diagnosed step.
+    Returns:
+        accuracy_lists (list): The accuracies of each step.
+    """
+    accuracy_lists = []
+    for s_np, g_np, a_np in trajectory:
+        accuracy_lists.append(sess.run(acc_list, feed_dict={s: s_np, g: g_np, a: a_np}))
+    return accuracy_lists
+
+
 def print_accuracy(accuracy_lists):
+    if len(accuracy_lists) == 0:
+        print('Accuracy: diagnostics disabled')
+        return
     acc = np.array(accuracy_lists)
     acc_list = []
     for i in range(acc.shape[1]):
@@ -115,10 +159,6 @@ def print_accuracy(accuracy_lists):
     print('Accuracy: {}'.format(acc_list))
 
 
-def render_init():
-    fig = plt.figure(figsize=(9, 4))
-    return fig
-
 def generate_circular_formation(num_agents, radius, min_dist):
     angles = np.linspace(0, 2 * np.pi, num_agents, endpoint=False)
     positions = np.array([radius * np.cos(angles), radius * np.sin(angles)]).T
@@ -134,7 +174,16 @@ def generate_circular_formation(num_agents, radius, min_dist):
 
 def main():
     args = parse_args()
-    s, g, a, loss_list, acc_list = build_evaluation_graph(args.num_agents)
+    # every batch runs batch_size whole episodes, so a remainder would evaluate
+    # more episodes than EVALUATE_STEPS
+    if args.batch_size < 1 or config.EVALUATE_STEPS % args.batch_size != 0:
+        raise ValueError('--batch_size {} must divide EVALUATE_STEPS ({}).'.format(
+            args.batch_size, config.EVALUATE_STEPS))
+    # seeds the scenario generation for reproducible runs
+    np.random.seed(args.seed)
+    # a single graph with a dynamic agent dimension serves several agent counts
+    graph_agents = args.num_agents[0] if len(args.num_agents) == 1 else None
+    s, g, formation, a, loss_list, acc_list, refine_steps, h = build_evaluation_graph(graph_agents, args.batch_size, args.refine)
 
     vars = tf.trainable_variables()
     vars_restore = [v for v in vars if 'action' in v.name or 'cbf' in v.name]
@@ -156,159 +205,166 @@ def main():
     safety_reward_baseline = []
     dist_reward_baseline = []
 
-    if args.vis:
-        plt.ion()
-        plt.close()
-        fig = render_init()
+    # The trajectories are streamed to disk rather than kept in memory, to
+    # --record or, when only visualized, next to the rendered videos
+    record_path = args.record
+    if args.vis and record_path is None:
+        os.makedirs(args.vis_output, exist_ok=True)
+        record_path = os.path.join(args.vis_output, 'trajectory.h5')
+    writer = trajectory.TrajectoryWriter(record_path) if record_path else None
 
     # Define formation radius parameters
-    desired_radius = 0.5  # Larger formation radius
-    radius_min = 0.4  # Minimum allowed radius
-    radius_max = 0.6  # Maximum allowed radius
-
-    for istep in range(config.EVALUATE_STEPS):
+    desired_radius = config.FORMATION_SCALE
+    radius_min = 0.8 * desired_radius  # Minimum allowed radius
+    radius_max = 1.2 * desired_radius  # Maximum allowed radius
+
+    # The stages of the control loop are timed with --profile, and the control
+    # steps in --trace_steps of every batch are traced op by op
+    profiler_total = profiling.StageProfiler(args.profile)
+
+    # Each evaluation step advances batch_size independent scenarios in lockstep
+    batch_size = args.batch_size
+    num_batches = config.EVALUATE_STEPS // batch_size
+    if args.bank:
+        banks = {n: scenario_bank.stream_scenarios(args.bank, n, batch_size, seed=args.seed)
+                 for n in set(args.num_agents)}
+
+    for istep in range(num_batches):
         start_time = time.time()
+        profiler = profiling.StageProfiler(args.profile)
 
-        safety_info = []
-        safety_info_baseline = []
+        unsafe_steps = 0
+        refine_steps_epoch = []
+        diagnosed_steps = []
         
-        num_agents = args.num_agents
-        num_circular = num_agents // 4  # 1/4 of agents form the circular formation
-        num_other = num_agents - num_circular  # Remaining agents
-
-        # Step 1: Generate leader and followers using formation_data
-        formation_states, formation_goals = core.formation_data(num_circular, config.DIST_MIN_THRES * 1.5)
-        leader_goal = formation_goals[0]  # Goal for the leader
-
-        # Step 2: Generate random goals for the remaining agents using generate_data
-        other_states, other_goals = core.generate_data(num_other, config.DIST_MIN_THRES * 1.5)
-
-        # Step 3: Merge all agents
-        s_np_ori = np.vstack([formation_states, other_states])
-        g_np_ori = np.vstack([formation_goals, other_goals])
+        # the batches cycle through the agent counts
+        num_agents = args.num_agents[istep % len(args.num_agents)]
+        with profiler.stage('scenario'):
+            if args.bank:
+                # Read the scenarios from the pre-generated bank
+                s_np_ori, g_np_ori, bank_formation = next(banks[num_agents])
+                num_circular = bank_formation.shape[-2]
+                leader_goals = list(g_np_ori[:, 0])
+            else:
+                num_circular = num_agents // 4  # 1/4 of agents form the circular formation
+
+                s_np_ori, g_np_ori, leader_goals = [], [], []
+                for b in range(batch_size):
+                    # Generate the leader and followers, and random goals for the remaining agents
+                    states, goals, _ = core.formation_scenario(num_agents, num_circular, config.DIST_MIN_THRES * 1.5)
+                    leader_goals.append(goals[0])  # Goal for the leader
+                    s_np_ori.append(states)
+                    g_np_ori.append(goals)
+                s_np_ori, g_np_ori = np.stack(s_np_ori), np.stack(g_np_ori)
 
         s_np, g_np = np.copy(s_np_ori), np.copy(g_np_ori)
-        init_dist_errors.append(np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)))
-
-        s_np_ours = []
-        s_np_mpc = []
+        # the desired formation of the batch, fed to every control step
+        formation_np = core.leader_formation(num_circular) if num_circular > 0 else np.zeros((0, 2))
+        init_dist_errors.extend(np.mean(np.linalg.norm(s_np[..., :2] - g_np, axis=-1), axis=-1))
 
-        safety_ours = []
-        safety_mpc = []
+        group = 'batch_{:05d}'.format(istep)
+        if writer:
+            writer.set_attrs(group, num_formation=num_circular)
+            writer.save(group + '/ours', goals=g_np_ori)
 
         # Step 4: Move agents to their goals while checking for collisions
         for i in range(config.INNER_LOOPS):
-            # Compute the control input
-            a_network, acc_list_np = sess.run([a, acc_list], feed_dict={s: s_np, g: g_np})
-            dsdt = np.concatenate([s_np[:, 2:], a_network], axis=1)
+            # Compute the control input. The accuracies are only fetched on the
+            # diagnosed steps, so the other steps run the controller alone
+            diagnose = args.diag_every > 0 and i % args.diag_every == 0
+            fetches = [a, refine_steps, h]
+            if diagnose and not args.diag_deferred:
+                fetches.append(acc_list)
+            with profiler.stage('inference'):
+                if i in args.trace_steps:
+                    values = profiling.run_traced(sess, fetches, {s: s_np, g: g_np, formation: formation_np}, os.path.join(
+                        args.trace_dir, '{}_step_{:03d}.json'.format(group, i)))
+                else:
+                    values = sess.run(fetches, feed_dict={s: s_np, g: g_np, formation: formation_np})
+            a_network, refine_steps_np, h_np = values[:3]
+            if diagnose and not args.diag_deferred:
+                accuracy_lists.append(values[3])
+            elif diagnose:
+                diagnosed_steps.append((s_np, g_np, a_network))
+            refine_steps_epoch.append(refine_steps_np)
+            profiler.count('control_steps')
+            profiler.count('refine_iters', int(refine_steps_np))
 
             # Simulate the system for one step
-            s_np = s_np + dsdt * config.TIME_STEP
-            s_np_ours.append(s_np)
+            with profiler.stage('integration'):
+                s_np = core.integrate(s_np, a_network)
 
             # Collision check
-            safety_ratio = 1 - np.mean(core.ttc_dangerous_mask_np(s_np, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK), axis=1)
-            safety_ours.append(safety_ratio)
-            safety_info.append((safety_ratio == 1).astype(np.float32).reshape((1, -1)))
-            safety_ratios_epoch.append(np.mean(safety_ratio == 1))
-            accuracy_lists.append(acc_list_np)
-
-            # Maintain the circular formation around the leader
-            leader_position = s_np[0, :2]  # Leader's position
-            followers_positions = s_np[1:num_circular, :2]  # Followers' positions
-
-            # Adjust followers' positions to maintain the formation and avoid collisions
-            for j in range(1, num_circular):
-                follower_position = s_np[j, :2]
-                direction = follower_position - leader_position
-                distance = np.linalg.norm(direction)
-
-                # Ensure the formation radius stays within the desired range
-                if distance < radius_min:
-                    # Push the follower away if too close to the leader
-                    s_np[j, :2] = leader_position + radius_min * (direction / distance)
-                elif distance > radius_max:
-                    # Pull the follower closer if too far from the leader
-                    s_np[j, :2] = leader_position + radius_max * (direction / distance)
-                else:
-                    # Maintain the desired radius
-                    s_np[j, :2] = leader_position + desired_radius * (direction / distance)
-
-                # Collision avoidance between formation agents
-                for k in range(1, num_circular):
-                    if k != j:
-                        other_follower_position = s_np[k, :2]
-                        dist_between_followers = np.linalg.norm(follower_position - other_follower_position)
-                        if dist_between_followers < config.DIST_MIN_CHECK:
-                            # Push the followers apart if they are too close
-                            avoidance_direction = follower_position - other_follower_position
-                            s_np[j, :2] += 0.1 * (avoidance_direction / dist_between_followers)
-
-        dist_errors.append(np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)))
-        safety_reward.append(np.mean(np.sum(np.concatenate(safety_info, axis=0) - 1, axis=0)))
-        dist_reward.append(np.mean((np.linalg.norm(s_np[:, :2] - g_np, axis=1) < 0.2).astype(np.float32) * 10))
-
-        # Step 5: Run simulation using MPC controller (baseline)
-        s_np, g_np = np.copy(s_np_ori), np.copy(g_np_ori)
-        for i in range(config.INNER_LOOPS):
-            K = np.eye(2, 4) + np.eye(2, 4, k=2) * np.sqrt(3)
-            s_ref = np.concatenate([s_np[:, :2] - g_np, s_np[:, 2:]], axis=1)
-            a_mpc = -s_ref.dot(K.T)
-            s_np = s_np + np.concatenate([s_np[:, 2:], a_mpc], axis=1) * config.TIME_STEP
-            s_np_mpc.append(s_np)
-
-            safety_ratio = 1 - np.mean(core.ttc_dangerous_mask_np(s_np, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK), axis=1)
-            safety_mpc.append(safety_ratio)
-            safety_info_baseline.append((safety_ratio == 1).astype(np.float32).reshape((1, -1)))
-            safety_ratios_epoch_mpc.append(np.mean(safety_ratio == 1))
-
-            if np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)) < config.DIST_MIN_CHECK / 3:
-                break
-
-        safety_reward_baseline.append(np.mean(np.sum(np.concatenate(safety_info_baseline, axis=0) - 1, axis=0)))
-        dist_reward_baseline.append(np.mean((np.linalg.norm(s_np[:, :2] - g_np, axis=1) < 0.2).astype(np.float32) * 10))
-
-        if args.vis:
-            vis_range = max(1, np.amax(np.abs(s_np_ori[:, :2])))
-            agent_size = 100 / vis_range ** 2
-            g_np = g_np / vis_range
-            for j in range(max(len(s_np_ours), len(s_np_mpc))):
-                plt.clf()
-
-                plt.subplot(121)
-                j_ours = min(j, len(s_np_ours)-1)
-                s_np = s_np_ours[j_ours] / vis_range
-                plt.scatter(s_np[:num_circular, 0], s_np[:num_circular, 1], color='darkorange', s=agent_size, label='Formation Agents', alpha=0.6)
-                plt.scatter(s_np[num_circular:, 0], s_np[num_circular:, 1], color='green', s=agent_size, label='Random Agents', alpha=0.6)
-                plt.scatter(leader_goal[0] / vis_range, leader_goal[1] / vis_range, color='deepskyblue', s=agent_size, label='Common Goal', alpha=0.6)
-                safety = np.squeeze(safety_ours[j_ours])
-                plt.scatter(s_np[safety < 1, 0], s_np[safety < 1, 1], color='red', s=agent_size, label='Collision', alpha=0.9)
-                plt.title('Ours: Safety Rate = {:.3f}'.format(np.mean(safety_ratios_epoch)), fontsize=14)
-
-                plt.subplot(122)
-                j_mpc = min(j, len(s_np_mpc)-1)
-                s_np = s_np_mpc[j_mpc] / vis_range
-                plt.scatter(s_np[:num_circular, 0], s_np[:num_circular, 1], color='darkorange', s=agent_size, label='Formation Agents', alpha=0.6)
-                plt.scatter(s_np[num_circular:, 0], s_np[num_circular:, 1], color='green', s=agent_size, label='Random Agents', alpha=0.6)
-                plt.scatter(leader_goal[0] / vis_range, leader_goal[1] / vis_range, color='deepskyblue', s=agent_size, label='Common Goal', alpha=0.6)
-                safety = np.squeeze(safety_mpc[j_mpc])
-                plt.scatter(s_np[safety < 1, 0], s_np[safety < 1, 1], color='red', s=agent_size, label='Collision', alpha=0.9)
-                plt.title('MPC: Safety Rate = {:.3f}'.format(np.mean(safety_ratios_epoch_mpc)), fontsize=14)
-
-                fig.canvas.draw()
-                plt.pause(0.01)
+            with profiler.stage('safety'):
+                safety_ratio = 1 - core.ttc_dangerous_count_np(s_np, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK) / np.shape(s_np)[-2]
+            safe = np.squeeze(safety_ratio == 1, -1)
+            unsafe_steps = unsafe_steps + (1 - safe)
+            safety_ratios_epoch.append(np.mean(safe))
+            if writer:
+                with profiler.stage('recording'):
+                    writer.append(group + '/ours', states=s_np, actions=a_network, cbf=np.squeeze(h_np, -1), safe=safe)
+
+            # Maintain the circular formation around the leader, and push apart
+            # followers that are too close to each other
+            if config.FORMATION_SHAPE == 'circle':
+                with profiler.stage('formation'):
+                    s_np = core.project_formation(
+                        s_np, num_circular, desired_radius, radius_min, radius_max, config.DIST_MIN_CHECK)
+
+        s_np_final = s_np
+        with profiler.stage('diagnostics'):
+            accuracy_lists.extend(run_diagnostics(sess, s, g, a, acc_list, diagnosed_steps))
+        with profiler.stage('metrics'):
+            dist_errors.extend(np.mean(np.linalg.norm(s_np[..., :2] - g_np, axis=-1), axis=-1))
+            safety_reward.extend(-np.mean(unsafe_steps, axis=-1))
+            dist_reward.extend(np.mean((np.linalg.norm(s_np[..., :2] - g_np, axis=-1) < 0.2).astype(np.float32) * 10, axis=-1))
+
+        # Step 5: Run simulation using MPC controller (baseline), all scenarios at once
+        with profiler.stage('baseline'):
+            trajectory_mpc, safety_ratios_mpc, num_steps_mpc = core.lqr_baseline_np(
+                s_np_ori, g_np_ori, stop_dist=config.DIST_MIN_CHECK / 3)
+        if writer:
+            with profiler.stage('recording'):
+                writer.extend(group + '/mpc', states=trajectory_mpc, safe=np.squeeze(safety_ratios_mpc == 1, -1))
+                writer.save(group + '/mpc', goals=g_np_ori, num_steps=num_steps_mpc)
+        with profiler.stage('metrics'):
+            for b, num_steps in enumerate(num_steps_mpc):
+                safety_info_baseline = (safety_ratios_mpc[:num_steps, b, :, 0] == 1).astype(np.float32)
+                safety_ratios_epoch_mpc.extend(np.mean(safety_info_baseline, axis=-1))
+                safety_reward_baseline.append(np.mean(np.sum(safety_info_baseline - 1, axis=0)))
+                s_np = trajectory_mpc[num_steps - 1, b]
+                dist_reward_baseline.append(np.mean((np.linalg.norm(s_np[:, :2] - g_np_ori[b], axis=1) < 0.2).astype(np.float32) * 10))
 
         end_time = time.time()
         computational_time = end_time - start_time
-        formation_error = np.mean(np.linalg.norm(s_np[:num_circular, :2] - leader_goal, axis=1))
+        leader_goals = np.expand_dims(np.stack(leader_goals), 1)
+        formation_error = np.mean(np.linalg.norm(s_np_final[:, :num_circular, :2] - leader_goals, axis=-1))
         safety_rate_ours = np.mean(safety_ratios_epoch)
         safety_rate_mpc = np.mean(safety_ratios_epoch_mpc)
 
-        print(f'Evaluation Step: {istep + 1} | {config.EVALUATE_STEPS}, Time: {computational_time:.4f}')
+        print(f'Evaluation Step: {istep + 1} | {num_batches}, Agents: {num_agents}, Time: {computational_time:.4f}, Episodes/s: {batch_size / computational_time:.2f}')
         print(f'Safety Rate (Ours): {safety_rate_ours:.4f}, Safety Rate (MPC): {safety_rate_mpc:.4f}')
         print(f'Formation Error: {formation_error:.4f}')
+        print(f'Refinement Iterations: {np.mean(refine_steps_epoch):.2f} mean, {np.max(refine_steps_epoch)} max')
+        if args.profile:
+            print(profiler.table(group))
+            profiler_total.merge(profiler)
 
     print_accuracy(accuracy_lists)
+    if args.profile:
+        print(profiler_total.table('all batches'))
+
+    if writer:
+        writer.close()
+        print('Recorded the trajectories to {}'.format(record_path))
+    if args.vis:
+        # The frames are drawn and encoded by a separate process once the
+        # evaluation is over, so matplotlib never runs in the evaluation loop
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render.py'),
+                   '--input', record_path, '--output', args.vis_output]
+        if args.vis_format:
+            command += ['--format', args.vis_format]
+        subprocess.run(command, check=True)
                     
 if __name__ == '__main__':
     main()
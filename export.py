@@ -0,0 +1,99 @@
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import argparse
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import config
+import evaluate
+
+# the tensors a deployed controller feeds, the formation being optional, and fetches
+INPUT_NODES = ['s', 'g', 'formation']
+OUTPUT_NODES = ['a_opt', 'refine_steps']
+# graph_transforms passes applied after the variables are frozen
+GRAPH_TRANSFORMS = ['remove_device', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=None)
+    parser.add_argument('--model_path', type=str, required=True)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--refine', type=str, default=config.REFINE_MODE, choices=['gradient', 'qp'])
+    args = parser.parse_args()
+    return args
+
+
+def export_controller(model_path, num_agents, output, batch_size=None, refine=config.REFINE_MODE):
+    """ Freezes the s, g -> a_opt path of a checkpoint into a single GraphDef.
+
+    Only the control graph is built, so the losses and accuracies of the
+    evaluation graph never reach the exported file. The network weights are
+    baked in as constants and the subgraphs that only depend on constants,
+    such as the desired formation, are folded ahead of time.
+
+    Args:
+        model_path (str): The checkpoint prefix, e.g. models/model_iter_9999.
+        num_agents (int): The number of agents the controller is built for, or
+            None for a controller that takes any number of agents.
+        output (str): The path of the .pb file to write.
+        batch_size (int): The leading batch dimension, or None for a single scenario.
+        refine (str): The refinement of the action, 'gradient' or 'qp'.
+    Returns:
+        graph_def (GraphDef): The frozen and optimized graph.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        evaluate.build_control_graph(num_agents, batch_size, refine)
+        vars_restore = [v for v in tf.global_variables() if 'action' in v.name or 'cbf' in v.name]
+        saver = tf.train.Saver(var_list=vars_restore)
+        with tf.Session() as sess:
+            saver.restore(sess, model_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), OUTPUT_NODES)
+    graph_def = TransformGraph(graph_def, INPUT_NODES, OUTPUT_NODES, GRAPH_TRANSFORMS)
+    tf.io.write_graph(graph_def, os.path.dirname(output) or '.',
+                      os.path.basename(output), as_text=False)
+    return graph_def
+
+
+def load_controller(graph_path):
+    """ Loads a controller written by export_controller into a fresh session.
+
+    Nothing has to be rebuilt or restored: the GraphDef is imported as is, so
+    the controller is ready as soon as the file is read.
+
+    Args:
+        graph_path (str): The path of the exported .pb file.
+    Returns:
+        sess (Session): The session owning the imported graph.
+        s, g: The state and goal placeholders to feed. The optional
+            'formation:0' takes the desired formation, every agent in the
+            configured formation by default.
+        a_opt (N, 2) or (B, N, 2): The refined action to fetch.
+    """
+    graph_def = tf.GraphDef()
+    with open(graph_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    sess = tf.Session(graph=graph)
+    s, g = [graph.get_tensor_by_name(name + ':0') for name in ['s', 'g']]
+    a_opt = graph.get_tensor_by_name('a_opt:0')
+    return sess, s, g, a_opt
+
+
+def main():
+    args = parse_args()
+    output = args.output or args.model_path + '_frozen.pb'
+    graph_def = export_controller(
+        args.model_path, args.num_agents, output, args.batch_size, args.refine)
+    print('Exported {} nodes to {}'.format(len(graph_def.node), output))
+
+
+if __name__ == '__main__':
+    main()
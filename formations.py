@@ -0,0 +1,99 @@
+import numpy as np
+
+# formation builders by shape name, each mapping (num_agents, scale, **params)
+# to the (num_agents, 2) positions of the followers around a leader at the origin
+FORMATION_SHAPES = {}
+# layouts by (kind, shape, num_agents, scale, params)
+_CACHE = {}
+
+
+def register_formation(name):
+    """ Registers a formation builder under name, for use as a decorator. """
+    def register(builder):
+        FORMATION_SHAPES[name] = builder
+        return builder
+    return register
+
+
+@register_formation('circle')
+def circle(num_agents, scale):
+    # the first and last agents share the point at angle 0, as in the original layout
+    angles = np.linspace(0.0, 2.0 * np.pi, num_agents)
+    return scale * np.column_stack((np.cos(angles), np.sin(angles)))
+
+
+@register_formation('line')
+def line(num_agents, scale):
+    rows = np.arange(1, num_agents + 1)
+    return scale * np.column_stack((-rows, np.zeros(num_agents)))
+
+
+@register_formation('wedge')
+def wedge(num_agents, scale, angle=np.pi / 4):
+    # followers alternate between the two arms of a V opening behind the leader
+    rows = np.arange(num_agents) // 2 + 1
+    sides = np.where(np.arange(num_agents) % 2 == 0, 1.0, -1.0)
+    return scale * np.column_stack((-rows * np.cos(angle), sides * rows * np.sin(angle)))
+
+
+@register_formation('grid')
+def grid(num_agents, scale):
+    # the leader takes the first slot of the grid
+    columns = int(np.ceil(np.sqrt(num_agents + 1)))
+    slots = np.arange(1, num_agents + 1)
+    return scale * np.column_stack((-(slots // columns), slots % columns))
+
+
+@register_formation('points')
+def points(num_agents, scale, points=()):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) != num_agents:
+        raise ValueError('The formation has {} points for {} agents.'.format(len(points), num_agents))
+    return scale * points
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _cached(kind, shape, num_agents, scale, params, build):
+    key = (kind, shape, int(num_agents), float(scale),
+           tuple(sorted((k, _freeze(v)) for k, v in params.items())))
+    if key not in _CACHE:
+        value = build()
+        value.setflags(write=False)
+        _CACHE[key] = value
+    return _CACHE[key]
+
+
+def formation_offsets(shape, num_agents, scale, **params):
+    """ Returns the layout of num_agents agents in a registered formation.
+
+    Args:
+        shape (str): A name in FORMATION_SHAPES.
+        num_agents (int): The number of agents in the layout.
+        scale (float): The radius, or the spacing between neighboring agents.
+        params: Extra arguments of the shape, e.g. the points of 'points'.
+    Returns:
+        offsets (num_agents, 2): A cached, read-only array.
+    """
+    if shape not in FORMATION_SHAPES:
+        raise ValueError('Unknown formation shape {}, expected one of {}.'.format(
+            shape, sorted(FORMATION_SHAPES)))
+    return _cached('offsets', shape, num_agents, scale, params, lambda: np.asarray(
+        FORMATION_SHAPES[shape](int(num_agents), scale, **params), dtype=np.float64))
+
+
+def leader_formation(shape, num_agents, scale, **params):
+    """ Returns the desired offsets of num_agents agents from the leader, with
+    the leader first at the origin and its num_agents - 1 followers after it.
+
+    Returns:
+        offsets (num_agents, 2): A cached, read-only array.
+    """
+    followers = formation_offsets(shape, num_agents - 1, scale, **params)
+    return _cached('leader', shape, num_agents, scale, params, lambda: np.concatenate(
+        [np.zeros((1, 2)), followers], axis=0))
+
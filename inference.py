@@ -0,0 +1,279 @@
+import struct
+
+import numpy as np
+
+import config
+import formations
+
+# DataType enum values of the TensorFlow checkpoint format
+CHECKPOINT_DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 9: np.int64, 10: np.bool_}
+
+
+def _read_varint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_block(buf, offset, size):
+    """ Returns the (key, value) entries of one uncompressed table block. """
+    if buf[offset + size] != 0:
+        raise ValueError('Compressed checkpoint index blocks are not supported.')
+    block = buf[offset:offset + size]
+    num_restarts = struct.unpack('<I', block[-4:])[0]
+    end = len(block) - 4 * (num_restarts + 1)
+    entries, key, pos = [], b'', 0
+    while pos < end:
+        shared, pos = _read_varint(block, pos)
+        non_shared, pos = _read_varint(block, pos)
+        value_length, pos = _read_varint(block, pos)
+        key = key[:shared] + block[pos:pos + non_shared]
+        pos += non_shared
+        entries.append((key, block[pos:pos + value_length]))
+        pos += value_length
+    return entries
+
+
+def _parse_message(buf):
+    """ Decodes a protobuf message into a dict of field number to list of values,
+    keeping varints as ints and length-delimited fields as bytes. """
+    fields, pos = {}, 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type in (1, 5):
+            size = 8 if wire_type == 1 else 4
+            value, pos = buf[pos:pos + size], pos + size
+        else:
+            raise ValueError('Unexpected wire type {} in checkpoint index.'.format(wire_type))
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def load_checkpoint(model_path, scopes=('cbf/', 'action/')):
+    """ Reads the network weights of a TensorFlow checkpoint without TensorFlow.
+
+    The .index file is a table of BundleEntryProto records giving the dtype,
+    shape and byte range of every variable in the .data shards.
+
+    Args:
+        model_path (str): The checkpoint prefix, e.g. models/model_iter_9999.
+        scopes (tuple): Only variables under these scopes are loaded. Optimizer
+            slots such as Adam moments are skipped.
+    Returns:
+        weights (dict): Variable name to NumPy array.
+    """
+    with open(model_path + '.index', 'rb') as f:
+        index = f.read()
+    # the table footer starts with the handles of the metaindex and index blocks
+    _, pos = _read_varint(index, len(index) - 48)
+    _, pos = _read_varint(index, pos)
+    index_offset, pos = _read_varint(index, pos)
+    index_size, pos = _read_varint(index, pos)
+
+    entries = []
+    for _, handle in _read_block(index, index_offset, index_size):
+        offset, pos = _read_varint(handle, 0)
+        size, _ = _read_varint(handle, pos)
+        entries.extend(_read_block(index, offset, size))
+    entries = dict(entries)
+
+    # the entry with the empty key is the BundleHeaderProto
+    num_shards = _parse_message(entries.pop(b''))[1][0]
+    shards = [np.memmap('{}.data-{:05d}-of-{:05d}'.format(model_path, i, num_shards),
+                        dtype=np.uint8, mode='r') for i in range(num_shards)]
+
+    weights = {}
+    for key, value in entries.items():
+        name = key.decode('utf-8')
+        if not name.startswith(tuple(scopes)) or 'Adam' in name:
+            continue
+        entry = _parse_message(value)
+        shape = [_parse_message(dim).get(1, [0])[0]
+                 for dim in _parse_message(entry.get(2, [b''])[0]).get(2, [])]
+        shard = shards[entry.get(3, [0])[0]]
+        offset, size = entry.get(4, [0])[0], entry.get(5, [0])[0]
+        weights[name] = np.frombuffer(
+            shard[offset:offset + size].tobytes(),
+            dtype=CHECKPOINT_DTYPES[entry[1][0]]).reshape(shape)
+    return weights
+
+
+def neighbor_candidates(s, k=config.TOP_K, r=config.OBS_RADIUS, levels=config.NEIGHBOR_LEVELS):
+    """ Enumerates the candidate neighbors that core.neighbor_indices ranks,
+    searching the 5x5 block of cells around each agent at the finest of the
+    grid levels whose own cell still holds k agents.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        k (int): The number of neighbors to select.
+        r (float): The observation radius.
+        levels (int): The number of grid levels.
+    Returns:
+        row, column (P,): Indices into the flattened agents of every
+            candidate pair, including each agent itself.
+        dist (P,): The squared distance of each pair.
+    """
+    n = s.shape[-2]
+    p = np.reshape(s[..., :2], (-1, n, 2))
+    batch = np.arange(p.shape[0]).reshape(-1, 1)
+    keys, widths, offset = [], [], 0
+    for level in range(levels):
+        cell = np.floor(p / (r / 2 ** (level + 1))).astype(np.int64)
+        cell = cell - np.min(cell, axis=(0, 1)) + 2
+        height = np.max(cell[:, :, 0]) + 3
+        width = np.max(cell[:, :, 1]) + 3
+        keys.append(np.reshape(offset + (batch * height + cell[:, :, 0]) * width + cell[:, :, 1], -1))
+        widths.append(width)
+        offset += p.shape[0] * height * width
+    p = np.reshape(p, (-1, 2))
+    m = p.shape[0]
+    keys = np.stack(keys)
+    order = np.argsort(keys, axis=None, kind='stable')
+    sorted_key = keys.reshape(-1)[order]
+
+    own_count = np.searchsorted(sorted_key, keys, side='right') - np.searchsorted(sorted_key, keys, side='left')
+    level = np.sum(own_count[1:] >= k, axis=0)
+    key = keys[level, np.arange(m)]
+    offset = np.arange(-2, 3)
+    offset = np.expand_dims(offset, 1) * np.reshape(np.array(widths)[level], (-1, 1, 1)) + offset
+    block_key = np.reshape(np.expand_dims(key, 1) + np.reshape(offset, (m, 25)), -1)
+    start = np.searchsorted(sorted_key, block_key, side='left')
+    count = np.searchsorted(sorted_key, block_key, side='right') - start
+
+    row = np.repeat(np.arange(m).repeat(25), count)
+    first = np.cumsum(count) - count
+    column = order[np.arange(np.sum(count)) - np.repeat(first - start, count)] % m
+    dist = np.sum(np.square(p[row] - p[column]), axis=1)
+    return row, column, dist
+
+
+def neighbor_indices(s, k=config.TOP_K, r=config.OBS_RADIUS):
+    """ NumPy version of core.neighbor_indices, selecting the k nearest neighbors
+    within r of each agent by multi-level grid hashing.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        k (int): The number of neighbors to select.
+        r (float): The observation radius.
+    Returns:
+        indices (N, k) or (B, N, k): The neighbor indices sorted by distance,
+            and -1 in slots with no agent within r.
+    """
+    n = s.shape[-2]
+    m = s.size // s.shape[-1]
+    row, column, dist = neighbor_candidates(s, k, r)
+    within = dist <= r ** 2
+    row, column, dist = row[within], column[within], dist[within]
+
+    ranked = np.lexsort((dist, row))
+    row, column = row[ranked], column[ranked]
+    rank = np.arange(len(row)) - np.searchsorted(row, np.arange(m), side='left')[row]
+    selected = rank < k
+    indices = -np.ones((m, k), dtype=np.int64)
+    indices[row[selected], rank[selected]] = column[selected] - row[selected] // n * n
+    return np.reshape(indices, s.shape[:-1] + (k,))
+
+
+def gather_neighbors(s, indices, r=config.OBS_RADIUS):
+    """ NumPy version of core.gather_neighbors, shape (..., N, k, C). """
+    n, c = s.shape[-2:]
+    rows = np.reshape(np.arange(s.size // c), s.shape[:-1])
+    columns = np.maximum(indices, 0) + np.expand_dims(rows // n * n, -1)
+    x = np.expand_dims(s, -2) - np.reshape(s, (-1, c))[columns]
+    valid = np.expand_dims(indices >= 0, -1)
+    far = 2.0 * r * np.eye(c, dtype=s.dtype)[0]
+    return np.where(valid, x, far)
+
+
+def neighbor_eye(indices):
+    """ NumPy version of core.neighbor_eye, shape (..., N, k, 1). """
+    rows = np.arange(indices.shape[-2]).reshape(-1, 1)
+    return np.expand_dims(indices == rows, -1).astype(np.float32)
+
+
+def _dense(x, weights, scope, activation=True):
+    kernel = weights[scope + '/weights']
+    # the 1x1 convolutions store a (1, C_in, C_out) kernel
+    x = np.matmul(x, kernel.reshape(kernel.shape[-2:])) + weights[scope + '/biases']
+    return np.maximum(x, 0) if activation else x
+
+
+def network_cbf(s, r, weights, indices=None):
+    """ NumPy forward pass of core.network_cbf.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        r (float): The radius of the safe regions.
+        weights (dict): The variables returned by load_checkpoint.
+        indices (N, k) or (B, N, k): The neighbor indices, searched if None.
+    Returns:
+        h (N, k, 1) or (B, N, k, 1): The control barrier function.
+        mask (N, k, 1) or (B, N, k, 1): The observation mask.
+        indices (N, k) or (B, N, k): The neighbor indices.
+    """
+    s = np.asarray(s, dtype=np.float32)
+    if indices is None:
+        indices = neighbor_indices(s, config.TOP_K)
+    x = gather_neighbors(s, indices)
+    dist = np.sqrt(np.sum(np.square(x[..., :2]) + 1e-4, axis=-1, keepdims=True))
+    x = np.concatenate([x, neighbor_eye(indices), dist - r], axis=-1)
+    mask = (dist <= config.OBS_RADIUS).astype(np.float32)
+    x = _dense(x, weights, 'cbf/conv_1')
+    x = _dense(x, weights, 'cbf/conv_2')
+    x = _dense(x, weights, 'cbf/conv_3')
+    x = _dense(x, weights, 'cbf/conv_4', activation=False)
+    return x * mask, mask, indices
+
+
+def network_action(s, g, weights, obs_radius=1.0, indices=None, leader_idx=0,
+                   desired_formation=None, stop_threshold=0.05):
+    """ NumPy forward pass of core.network_action.
+
+    Args:
+        s (N, 4) or (B, N, 4): The current state of N agents.
+        g (N, 2) or (B, N, 2): The goal of each agent.
+        weights (dict): The variables returned by load_checkpoint.
+        indices (N, k) or (B, N, k): The neighbor indices, searched if None.
+        desired_formation (M, 2): The offsets of the first M agents from the
+            leader, every agent in the configured formation if None.
+    Returns:
+        a (N, 2) or (B, N, 2): The acceleration of each agent.
+    """
+    s = np.asarray(s, dtype=np.float32)
+    g = np.asarray(g, dtype=np.float32)
+    stop_mask = np.linalg.norm(s[..., :2] - g, axis=-1, keepdims=True) > stop_threshold
+
+    leader_position = s[..., leader_idx:leader_idx + 1, :2]
+    if desired_formation is None:
+        desired_formation = formations.leader_formation(
+            config.FORMATION_SHAPE, s.shape[-2], config.FORMATION_SCALE, **config.FORMATION_PARAMS)
+    num_formation = len(desired_formation)
+    formation_error = s[..., :num_formation, :2] - (desired_formation + leader_position)
+    formation_error = np.concatenate(
+        [formation_error, np.zeros_like(s[..., num_formation:, :2])], axis=-2)
+
+    if indices is None:
+        indices = neighbor_indices(s, config.TOP_K, obs_radius)
+    x = gather_neighbors(s, indices, obs_radius)
+    mask = np.linalg.norm(x[..., :2], axis=-1, keepdims=True) < obs_radius
+    x = np.max(_dense(x, weights, 'action/conv_1') * mask, axis=-2)
+    x = np.concatenate([x, s[..., :2] - g, s[..., 2:]], axis=-1)
+    x = _dense(x, weights, 'action/fc_1')
+    x = _dense(x, weights, 'action/fc_4', activation=False)
+    k_1, k_2, k_3, k_4 = np.split(2.0 / (1.0 + np.exp(-x)) + 0.2, 4, axis=-1)
+
+    state = np.concatenate([s[..., :2] - g, s[..., 2:]], axis=-1)
+    a_x = -(k_1 * state[..., 0:1] + k_2 * state[..., 2:3]) + formation_error[..., 0:1]
+    a_y = -(k_3 * state[..., 1:2] + k_4 * state[..., 3:4]) + formation_error[..., 1:2]
+    return (np.concatenate([a_x, a_y], axis=-1) * stop_mask).astype(np.float32)
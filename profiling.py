@@ -0,0 +1,104 @@
+import os
+import time
+import collections
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start_time)
+
+
+class _Disabled(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_DISABLED = _Disabled()
+
+
+class StageProfiler(object):
+    """ Accumulates the wall time of named stages and the value of counters.
+
+    Stages are timed with `with profiler.stage(name):`. A disabled profiler
+    hands out a shared no-op context, so the hooks can stay in the control
+    loop at the cost of one attribute lookup per stage.
+
+    Args:
+        enabled (bool): Whether to time anything at all.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.times = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _DISABLED
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def merge(self, other):
+        """ Adds the times and counters of another profiler to this one. """
+        for name, seconds in other.times.items():
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + other.calls[name]
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def table(self, title=''):
+        """ Formats the stages as a table of calls, total and mean time, and
+        share of the total, followed by the counters. """
+        total = sum(self.times.values())
+        lines = ['{:<14} {:>7} {:>11} {:>10} {:>7}'.format(
+            title, 'Calls', 'Total ms', 'Mean ms', 'Share')]
+        for name, seconds in self.times.items():
+            lines.append('{:<14} {:>7d} {:>11.2f} {:>10.3f} {:>6.1f}%'.format(
+                name, self.calls[name], 1000 * seconds, 1000 * seconds / self.calls[name],
+                100 * seconds / max(total, 1e-12)))
+        lines.append('{:<14} {:>7} {:>11.2f}'.format('total', '', 1000 * total))
+        for name, value in self.counters.items():
+            lines.append('{:<14} {:>7} {:>11}'.format(name, '', value))
+        return '\n'.join(lines)
+
+
+def run_traced(sess, fetches, feed_dict, path):
+    """ Runs fetches once with a full step trace and writes it to path.
+
+    The trace is in the Chrome trace format and shows the time of every op,
+    e.g. each iteration of the refinement loop, in chrome://tracing.
+
+    Returns:
+        The fetched values, as sess.run.
+    """
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    values = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+    return values
@@ -0,0 +1,183 @@
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import argparse
+import multiprocessing
+import h5py
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib import animation
+
+import trajectory
+
+# the controllers drawn side by side, by recorded group and panel title
+PANELS = [('ours', 'Ours'), ('mpc', 'MPC')]
+# the encoder of each video format, image sequences are written as PNG files
+VIDEO_WRITERS = {'mp4': animation.FFMpegWriter, 'gif': animation.PillowWriter}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--format', type=str, default=None, choices=['mp4', 'gif', 'png'])
+    parser.add_argument('--fps', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--show', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def default_format():
+    return 'mp4' if animation.writers.is_available('ffmpeg') else 'gif'
+
+
+def build_figure(f, group, scenario):
+    """ Creates the figure of one scenario with an artist per agent class.
+
+    The axes limits are fixed from the whole trajectory, so a frame only moves
+    the scatter offsets and the artists can be blitted.
+
+    Args:
+        f (h5py.File): The recorded file.
+        group (str): The group of the evaluation batch, e.g. 'batch_00000'.
+        scenario (int): The index of the scenario in the batch.
+    Returns:
+        fig (Figure): The figure.
+        update: Maps a frame, the (states, safe) of each panel, to the
+            artists it changed.
+    """
+    num_formation = f[group].attrs['num_formation']
+    leader_goal = f[group]['ours/goals'][scenario, 0]
+    low, high = leader_goal.copy(), leader_goal.copy()
+    for name, _ in PANELS:
+        for states, in trajectory.read_blocks(f, group + '/' + name, ['states']):
+            low = np.minimum(low, np.min(states[:, scenario, :, :2], axis=(0, 1)))
+            high = np.maximum(high, np.max(states[:, scenario, :, :2], axis=(0, 1)))
+    titles = ['{}: Safety Rate = {:.3f}'.format(title, trajectory.trajectory_metrics(
+        f, group + '/' + name)['safety_rate']) for name, title in PANELS]
+    margin = 0.05 * np.max(high - low) + 1e-3
+    agent_size = 100 / max(1, np.max(np.abs([low, high]))) ** 2
+
+    fig, axes = plt.subplots(1, len(PANELS), figsize=(9, 4))
+    panels = []
+    for ax, title in zip(axes, titles):
+        ax.set_xlim(low[0] - margin, high[0] + margin)
+        ax.set_ylim(low[1] - margin, high[1] + margin)
+        ax.set_title(title, fontsize=14)
+        empty = np.zeros((0, 2))
+        formation = ax.scatter(empty[:, 0], empty[:, 1], color='darkorange', s=agent_size, label='Formation Agents', alpha=0.6)
+        free = ax.scatter(empty[:, 0], empty[:, 1], color='green', s=agent_size, label='Random Agents', alpha=0.6)
+        ax.scatter(leader_goal[0], leader_goal[1], color='deepskyblue', s=agent_size, label='Common Goal', alpha=0.6)
+        collision = ax.scatter(empty[:, 0], empty[:, 1], color='red', s=agent_size, label='Collision', alpha=0.9)
+        panels.append((formation, free, collision))
+
+    def update(frame):
+        artists = []
+        for (formation, free, collision), (states, safe) in zip(panels, frame):
+            p = states[scenario, :, :2]
+            formation.set_offsets(p[:num_formation])
+            free.set_offsets(p[num_formation:])
+            collision.set_offsets(p[~safe[scenario]])
+            artists.extend([formation, free, collision])
+        return artists
+
+    return fig, update
+
+
+def frames(f, group):
+    """ Yields the (states, safe) of every panel at each step. A controller
+    that stopped early, such as the baseline, holds its last frame. """
+    replays = [trajectory.replay(f, group + '/' + name, ['states', 'safe']) for name, _ in PANELS]
+    current = [None] * len(replays)
+    while True:
+        step = [next(replay, None) for replay in replays]
+        if all(s is None for s in step):
+            return
+        current = [c if s is None else s for s, c in zip(step, current)]
+        yield current
+
+
+def render_scenario(source, group, scenario, output, fps=20, show=False):
+    """ Draws one scenario of a recorded batch, to a file or on screen.
+
+    Args:
+        source (str): The recorded file.
+        group (str): The group of the evaluation batch.
+        scenario (int): The index of the scenario in the batch.
+        output (str): A .mp4 or .gif file, or a directory for PNG frames.
+        fps (int): The frames per second of the video or of the preview.
+        show (bool): Whether to play the animation in a window instead.
+    """
+    with h5py.File(source, 'r') as f:
+        fig, update = build_figure(f, group, scenario)
+        if show:
+            anim = animation.FuncAnimation(
+                fig, update, frames=frames(f, group), interval=1000 / fps,
+                blit=True, repeat=False, cache_frame_data=False)
+            plt.show()
+            return anim
+        extension = os.path.splitext(output)[1].lstrip('.')
+        if extension in VIDEO_WRITERS:
+            writer = VIDEO_WRITERS[extension](fps=fps)
+            with writer.saving(fig, output, dpi=fig.dpi):
+                for frame in frames(f, group):
+                    update(frame)
+                    writer.grab_frame()
+        else:
+            os.makedirs(output, exist_ok=True)
+            for i, frame in enumerate(frames(f, group)):
+                update(frame)
+                fig.savefig(os.path.join(output, 'frame_{:05d}.png'.format(i)))
+    plt.close(fig)
+
+
+def _render_job(job):
+    # the workers never open a window
+    plt.switch_backend('Agg')
+    render_scenario(*job)
+    return job[3]
+
+
+def render_recording(source, output, video_format=None, fps=20, workers=1):
+    """ Renders every scenario of a file recorded by evaluate --record.
+
+    Scenarios are encoded in parallel by a pool of worker processes, each
+    with its own headless figure.
+
+    Returns:
+        outputs (list): The written files or frame directories.
+    """
+    video_format = video_format or default_format()
+    jobs = []
+    with h5py.File(source, 'r') as f:
+        for group in sorted(f):
+            for scenario in range(f[group]['ours/goals'].shape[0]):
+                name = '{}_{}'.format(group, scenario)
+                if video_format != 'png':
+                    name += '.' + video_format
+                jobs.append((source, group, scenario, os.path.join(output, name), fps))
+    os.makedirs(output, exist_ok=True)
+    if workers <= 1:
+        return [_render_job(job) for job in jobs]
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        return pool.map(_render_job, jobs)
+
+
+def main():
+    args = parse_args()
+    if args.show:
+        with h5py.File(args.input, 'r') as f:
+            scenarios = [(group, scenario) for group in sorted(f)
+                         for scenario in range(f[group]['ours/goals'].shape[0])]
+        for group, scenario in scenarios:
+            render_scenario(args.input, group, scenario, None, args.fps, show=True)
+        return
+    output = args.output or os.path.splitext(args.input)[0]
+    outputs = render_recording(args.input, output, args.format, args.fps, args.workers)
+    print('Rendered {} scenarios to {}'.format(len(outputs), output))
+
+
+if __name__ == '__main__':
+    main()
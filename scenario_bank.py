@@ -0,0 +1,154 @@
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import queue
+import argparse
+import threading
+import numpy as np
+
+import core
+import config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--num_agents', type=int, nargs='+', required=True)
+    parser.add_argument('--num_scenarios', type=int, default=1000)
+    parser.add_argument('--formation_fraction', type=float, default=0.25)
+    parser.add_argument('--dist_min_thres', type=float, default=config.DIST_MIN_THRES * 1.5)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    return args
+
+
+def bank_files(path, num_agents):
+    """ Returns the .npy files holding the states, goals and formation offsets
+    of the scenarios with num_agents agents. """
+    return [os.path.join(path, 'agents_{}_{}.npy'.format(num_agents, name))
+            for name in ['states', 'goals', 'formation']]
+
+
+def build_bank(path, agent_counts, num_scenarios, formation_fraction=0.25,
+               dist_min_thres=config.DIST_MIN_THRES * 1.5):
+    """ Pre-generates scenarios into one set of .npy files per agent count.
+
+    The arrays are written through memory maps, so a bank larger than memory
+    never has to be held at once.
+
+    Args:
+        path (str): The directory of the bank.
+        agent_counts (list): The numbers of agents to generate scenarios for.
+        num_scenarios (int): The number of scenarios per agent count.
+        formation_fraction (float): The fraction of agents in the formation,
+            as in evaluate. 0 gives the free agents used in training.
+        dist_min_thres (float): The minimum distance between the free agents.
+    """
+    os.makedirs(path, exist_ok=True)
+    for num_agents in agent_counts:
+        num_formation = int(num_agents * formation_fraction)
+        shapes = [(num_scenarios, num_agents, 4), (num_scenarios, num_agents, 2),
+                  (num_scenarios, num_formation, 2)]
+        arrays = [np.lib.format.open_memmap(f, mode='w+', dtype=np.float32, shape=shape)
+                  for f, shape in zip(bank_files(path, num_agents), shapes)]
+        for i in range(num_scenarios):
+            scenario = core.formation_scenario(num_agents, num_formation, dist_min_thres)
+            for array, value in zip(arrays, scenario):
+                array[i] = value
+        for array in arrays:
+            array.flush()
+
+
+def load_bank(path, num_agents):
+    """ Opens the scenarios with num_agents agents as read-only memory maps.
+
+    Returns:
+        states (M, N, 4), goals (M, N, 2), formation (M, F, 2): The scenarios.
+    """
+    return [np.load(f, mmap_mode='r') for f in bank_files(path, num_agents)]
+
+
+def stream_scenarios(path, num_agents, batch_size=None, shuffle=True, prefetch=8, seed=None):
+    """ Yields scenarios from a bank without end, reading ahead on a thread.
+
+    A background thread gathers the next batches straight from the memory
+    maps while the caller simulates, so generating or reading a scenario never
+    shows up in the timing of a step. The bank is reshuffled on every pass.
+    An error on the thread, e.g. an unreadable bank, is re-raised to the caller.
+
+    Args:
+        path (str): The directory of the bank.
+        num_agents (int): The number of agents of the scenarios.
+        batch_size (int): The number of scenarios stacked per item, or None
+            for a single scenario without a batch dimension.
+        shuffle (bool): Whether to visit the scenarios in random order.
+        prefetch (int): The number of items read ahead.
+        seed (int): Seeds the shuffling.
+    Yields:
+        states (N, 4) or (B, N, 4), goals (N, 2) or (B, N, 2),
+        formation (F, 2) or (B, F, 2): Writable copies of the scenarios.
+    """
+    arrays = load_bank(path, num_agents)
+    num_scenarios = arrays[0].shape[0]
+    if num_scenarios < (batch_size or 1):
+        raise ValueError('The bank holds {} scenarios, fewer than a batch of {}.'.format(
+            num_scenarios, batch_size))
+    rng = np.random.RandomState(seed)
+    items = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # wait for room, but give up once the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            while not stop.is_set():
+                order = rng.permutation(num_scenarios) if shuffle else np.arange(num_scenarios)
+                for start in range(0, num_scenarios, batch_size or 1):
+                    index = order[start:start + (batch_size or 1)]
+                    if len(index) < (batch_size or 1):
+                        break
+                    if batch_size is None:
+                        index = index[0]
+                    if not put([np.array(array[index]) for array in arrays]):
+                        return
+        except Exception as e:
+            # hand the error to the consumer instead of dying silently
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item = items.get(timeout=0.1)
+            except queue.Empty:
+                if not thread.is_alive() and items.empty():
+                    raise RuntimeError('The scenario reader of {} stopped.'.format(path))
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    build_bank(args.output, args.num_agents, args.num_scenarios,
+               args.formation_fraction, args.dist_min_thres)
+    print('Wrote {} scenarios for {} agents to {}'.format(
+        args.num_scenarios, args.num_agents, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,35 @@ import sys
 sys.dont_write_bytecode = True
 
 import os
+import time
+import queue
 import h5py
 import argparse
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 
 import core
 import config
+import scenario_bank
 
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
 np.set_printoptions(4)
 
+# the rollouts each worker can have written ahead of the learner
+ROLLOUT_BUFFERS = 2
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--num_agents', type=int, required=True)
     parser.add_argument('--model_path', type=str, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--bank', type=str, default=None)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--batch_scenarios', type=int, default=0)
+    parser.add_argument('--in_graph_rollout', type=int, default=0)
     parser.add_argument('--gpu', type=str, default='0')
     args = parser.parse_args()
     return args
@@ -49,32 +61,101 @@ def build_optimizer(loss):
     return zero_ops, accumulate_ops, train_step_h, train_step_a
 
 
-def build_training_graph(num_agents):
-    num_agents = int(num_agents)  # Convert to Python integer before passing
-    s = tf.placeholder(tf.float32, [num_agents, 4])
-    g = tf.placeholder(tf.float32, [num_agents, 2])
+def build_batch_optimizer(loss):
+    """ Applies the gradient of a loss over a whole minibatch in one step,
+    without the accumulators of build_optimizer. """
+    optimizer = tf.train.AdamOptimizer(learning_rate=config.LEARNING_RATE)
+    grad_pairs = optimizer.compute_gradients(loss, tf.trainable_variables())
+    train_step_h = optimizer.apply_gradients([(grad, var) for grad, var in grad_pairs if 'cbf' in var.name])
+    train_step_a = optimizer.apply_gradients([(grad, var) for grad, var in grad_pairs if 'action' in var.name])
+    return train_step_h, train_step_a
+
+
+def build_rollout_graph(num_agents, batch_size=1):
+    """ Builds the rollout of the learned controller from a batch of scenarios
+    as a single tf.while_loop.
+
+    Each iteration runs the action network, adds noise with probability
+    ADD_NOISE_PROB, integrates core.dynamics and checks the safety of the new
+    state against the TOP_K nearest neighbors. The loop stops after
+    INNER_LOOPS steps, or once every scenario is within DIST_MIN_CHECK of its
+    goals on average. The safety check covers every pair of agents, so the
+    safety ratios match those of the NumPy rollouts.
+
+    Returns:
+        s (B, N, 4), g (B, N, 2): The initial state and goal placeholders.
+        states (T, B, N, 4): The state before each step.
+        s_final (B, N, 4): The state after the last step.
+        safety_ratios (T,): The fraction of safe agents after each step.
+    """
+    s = tf.placeholder(tf.float32, [batch_size, num_agents, 4])
+    g = tf.placeholder(tf.float32, [batch_size, num_agents, 2])
+    formation = core.leader_formation(num_agents)
+    # variables cannot be created inside the loop, so build the network once outside it
+    core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, desired_formation=formation)
+
+    def body(i, s_i, states, safety_ratios):
+        a = core.network_action(s=s_i, g=g, obs_radius=config.OBS_RADIUS,
+                                neighbors=core.build_neighbors(s_i), desired_formation=formation)
+        noise = tf.random.normal(tf.shape(a)) * config.NOISE_SCALE
+        a = tf.cond(tf.random.uniform([]) < config.ADD_NOISE_PROB, lambda: a + noise, lambda: a)
+        s_next = core.integrate(s_i, a)
+        # an agent is safe when no other agent is dangerous to it, checked over
+        # all pairs as in the NumPy rollouts rather than the TOP_K nearest
+        dangerous = core.ttc_dangerous_mask(
+            s_next, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK, core.all_neighbors(s_next))
+        safe = tf.logical_not(tf.reduce_any(dangerous, axis=[-2, -1]))
+        return (i + 1, s_next, states.write(i, s_i),
+                safety_ratios.write(i, tf.reduce_mean(tf.cast(safe, tf.float32))))
+
+    def cond(i, s_i, states, safety_ratios):
+        dist_errors = tf.reduce_mean(tf.norm(s_i[..., :2] - g, axis=-1), axis=-1)
+        converged = tf.logical_and(i > 0, tf.reduce_all(dist_errors < config.DIST_MIN_CHECK))
+        return tf.logical_and(i < config.INNER_LOOPS, tf.logical_not(converged))
+
+    _, s_final, states, safety_ratios = tf.while_loop(cond, body, [
+        tf.constant(0), s,
+        tf.TensorArray(tf.float32, size=0, dynamic_size=True),
+        tf.TensorArray(tf.float32, size=0, dynamic_size=True)])
+    return s, g, states.stack(), s_final, safety_ratios.stack()
+
+
+def build_training_graph(num_agents=None, batched=False, states=None, goals=None):
+    # with num_agents None, the graph takes swarms of any size
+    if num_agents is not None:
+        num_agents = int(num_agents)  # Convert to Python integer before passing
+    # batched graphs take any number of states, e.g. every visited state of
+    # several rollouts, and average the losses over all of them
+    batch_shape = [None] if batched else []
+    if states is None:
+        s = tf.placeholder(tf.float32, batch_shape + [num_agents, 4])
+        g = tf.placeholder(tf.float32, batch_shape + [num_agents, 2])
+    else:
+        # train on states computed in the graph, such as an in-graph rollout
+        s = tf.placeholder_with_default(states, batch_shape + [num_agents, 4])
+        g = tf.placeholder_with_default(goals, batch_shape + [num_agents, 2])
     
-    x = tf.expand_dims(s, 1) - tf.expand_dims(s, 0)
-    h, mask, indices = core.network_cbf(x=x, r=config.DIST_MIN_THRES, indices=None)
-    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, indices=indices)
+    # Define desired formation (config.FORMATION_SHAPE, a circle by default),
+    # shared by the action network and the losses
+    desired_formation = core.leader_formation(core.agent_count(s))
+
+    neighbors = core.build_neighbors(s)
+    h, mask, _ = core.network_cbf(s=s, r=config.DIST_MIN_THRES, neighbors=neighbors)
+    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS, neighbors=neighbors,
+                            desired_formation=desired_formation)
 
     (loss_dang, loss_safe, acc_dang, acc_safe) = core.loss_barrier(h=h, s=s, r=config.DIST_MIN_THRES, 
-                                                                    ttc=config.TIME_TO_COLLISION, indices=indices)
+                                                                    ttc=config.TIME_TO_COLLISION, neighbors=neighbors)
     (loss_dang_deriv, loss_safe_deriv, acc_dang_deriv, acc_safe_deriv) = core.loss_derivatives(
-        s=s, a=a, h=h, x=x, r=config.DIST_MIN_THRES, indices=indices, 
+        s=s, a=a, h=h, r=config.DIST_MIN_THRES, neighbors=neighbors, 
         ttc=config.TIME_TO_COLLISION, alpha=config.ALPHA_CBF)
 
-    # Define desired formation (e.g., a circular formation)
-    desired_formation = core.define_circular_formation(num_agents, radius=0.5)  # Example formation
-    desired_relative_positions = np.expand_dims(desired_formation, 1) - np.expand_dims(desired_formation, 0)
-
     # Compute loss_action using the loss_actions function
     loss_action = core.loss_actions(s=s, g=g, a=a, desired_formation=desired_formation, 
                                     r=config.DIST_MIN_THRES, ttc=config.TIME_TO_COLLISION)
 
-    # Formation loss: Encourage agents to maintain relative formation
-    actual_relative_positions = tf.expand_dims(s[:, :2], 1) - tf.expand_dims(s[:, :2], 0)
-    loss_formation = tf.reduce_mean(tf.square(actual_relative_positions - desired_relative_positions))
+    # Formation loss: Encourage neighboring agents to maintain relative formation
+    loss_formation = core.loss_formation(s=s, desired_formation=desired_formation, neighbors=neighbors)
 
     # Combine all loss terms
     loss_list = [2 * loss_dang, loss_safe, 2 * loss_dang_deriv, loss_safe_deriv, 0.01 * loss_action, 0.1 * loss_formation]
@@ -92,78 +173,370 @@ def count_accuracy(accuracy_lists):
     return acc_list
 
 
-def main():
-    args = parse_args()
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+def rollout(s_np, g_np, step):
+    """ Rolls the learned controller out for at most INNER_LOOPS steps.
+
+    Args:
+        s_np (N, 4): The initial state.
+        g_np (N, 2): The goals.
+        step: Maps the current state to the action and any extra fetches.
+    Returns:
+        s_np (N, 4): The final state.
+        states (list): The state before each step.
+        outs (list): The extra fetches of each step.
+        safety_ratios (list): The fraction of safe agents after each step.
+    """
+    s_np = np.copy(s_np)
+    states, outs, safety_ratios = [], [], []
+    for i in range(config.INNER_LOOPS):
+        states.append(np.copy(s_np))
+        a_np, out = step(s_np)
+        if np.random.uniform() < config.ADD_NOISE_PROB:
+            noise = np.random.normal(size=np.shape(a_np)) * config.NOISE_SCALE
+            a_np += noise
+
+        s_np = core.integrate(s_np, a_np).astype(s_np.dtype)
+        safety_ratio = 1 - core.ttc_dangerous_count_np(s_np, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK) / np.shape(s_np)[-2]
+        safety_ratios.append(np.mean(safety_ratio == 1))
+        outs.append(out)
+
+        if np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)) < config.DIST_MIN_CHECK:
+            break
+    return s_np, states, outs, safety_ratios
+
+
+def lqr_rollout(s_np, g_np):
+    """ Rolls the LQR baseline out and returns the fraction of safe agents after
+    each step, as one list per scenario when s_np holds a batch. """
+    _, safety_ratios, num_steps = core.lqr_baseline_np(s_np, g_np, bounds=(0, 1))
+    safety_ratios = np.mean(safety_ratios == 1, axis=(-2, -1))
+    if np.ndim(num_steps) == 0:
+        return list(safety_ratios[:num_steps])
+    return [list(safety_ratios[:n, b]) for b, n in enumerate(num_steps)]
+
+
+def sample_scenario(num_agents, bank=None):
+    if bank is not None:
+        s_np, g_np, _ = next(bank)
+        return s_np, g_np
+    return core.generate_data(num_agents, config.DIST_MIN_THRES)
+
+
+class SharedRollouts(object):
+    """ Rollout buffers of the workers in shared memory.
+
+    Each worker owns ROLLOUT_BUFFERS slots of INNER_LOOPS steps. A worker
+    writes a rollout straight into a free slot and only sends its slot and
+    lengths through a queue, so the states are never pickled. The learner
+    copies a rollout out of its slot as soon as it reads it and hands the slot
+    back, so a minibatch may hold any number of rollouts per worker.
+
+    Args:
+        context: The multiprocessing context of the workers.
+        num_workers (int): The number of workers.
+        num_agents (int): The number of agents of the scenarios.
+    """
+
+    def __init__(self, context, num_workers, num_agents):
+        slots = (num_workers, ROLLOUT_BUFFERS)
+        self.shapes = {'states': slots + (config.INNER_LOOPS, num_agents, 4),
+                       'goals': slots + (num_agents, 2),
+                       'safety_ratios': slots + (config.INNER_LOOPS,),
+                       'safety_ratios_lqr': slots + (config.INNER_LOOPS,)}
+        self.buffers = {name: context.RawArray('f', int(np.prod(shape)))
+                        for name, shape in self.shapes.items()}
+        # (worker, slot, num_steps, num_steps_lqr, init_dist_error, dist_error) of finished rollouts
+        self.ready = context.Queue()
+        # the slots of each worker that the learner is done with
+        self.free = [context.Queue() for _ in range(num_workers)]
+        for free in self.free:
+            for slot in range(ROLLOUT_BUFFERS):
+                free.put(slot)
+
+    def view(self, name):
+        """ Returns the buffer name as an array, without copying it. """
+        return np.frombuffer(self.buffers[name], dtype=np.float32).reshape(self.shapes[name])
+
+    def write(self, worker, states, g_np, init_dist_error, dist_error, safety_ratios, safety_ratios_lqr):
+        """ Writes a rollout into the next free slot of worker, waiting for one. """
+        slot = self.free[worker].get()
+        for name, value in [('states', states), ('goals', g_np), ('safety_ratios', safety_ratios),
+                            ('safety_ratios_lqr', safety_ratios_lqr)]:
+            self.view(name)[worker, slot, ...][:len(value)] = value
+        self.ready.put((worker, slot, len(states), len(safety_ratios_lqr), init_dist_error, dist_error))
+
+    def read(self, workers):
+        """ Waits for the next rollout, failing instead of hanging if every worker has exited.
+
+        Returns:
+            rollout (tuple): (states, goals, init_dist_error, dist_error,
+                safety_ratios, safety_ratios_lqr), copied out of the slot.
+        """
+        while True:
+            try:
+                worker, slot, num_steps, num_steps_lqr, init_dist_error, dist_error = self.ready.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    raise RuntimeError('All rollout workers have exited.')
+        rollout = (np.array(self.view('states')[worker, slot, :num_steps]),
+                   np.array(self.view('goals')[worker, slot]),
+                   init_dist_error, dist_error,
+                   list(self.view('safety_ratios')[worker, slot, :num_steps]),
+                   list(self.view('safety_ratios_lqr')[worker, slot, :num_steps_lqr]))
+        # the worker may write its next rollout while the learner still collects the minibatch
+        self.free[worker].put(slot)
+        return rollout
+
+    def close(self):
+        # slots nobody will take must not keep the process from exiting
+        for free in self.free:
+            free.cancel_join_thread()
+
+
+class SharedWeights(object):
+    """ The action network weights of the learner in shared memory.
+
+    The learner copies its variables into one flat buffer and bumps a version,
+    and a worker reloads them only when the version has changed, so the
+    weights are written once per sync however many workers read them.
+
+    Args:
+        context: The multiprocessing context of the workers.
+        variables (list): The variables to share, with static shapes.
+    """
+
+    def __init__(self, context, variables):
+        self.layout = [(v.op.name, tuple(v.shape.as_list())) for v in variables]
+        self.buffer = context.RawArray('f', int(sum(np.prod(shape) for _, shape in self.layout)))
+        self.version = context.RawValue('i', 0)
+        self.lock = context.Lock()
+
+    def _split(self):
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for _, shape in self.layout])
+        return [(name, flat[start:end].reshape(shape))
+                for (name, shape), start, end in zip(self.layout, offsets[:-1], offsets[1:])]
+
+    def publish(self, sess, variables):
+        """ Writes the current values of variables, in the order they were shared. """
+        values = sess.run(variables)
+        with self.lock:
+            for (_, view), value in zip(self._split(), values):
+                view[...] = value
+            self.version.value += 1
+
+    def load(self, sess, variables, version):
+        """ Loads the weights into variables, a dict by name, if they are newer
+        than version, waiting for the first ones. Returns the loaded version. """
+        while self.version.value == 0:
+            time.sleep(0.1)
+        if self.version.value == version:
+            return version
+        with self.lock:
+            for name, view in self._split():
+                variables[name].load(view, sess)
+            return self.version.value
+
+
+def rollout_worker(worker, num_agents, bank_path, seed, weights, rollouts):
+    """ Generates rollouts in a separate process until it is terminated.
+
+    The worker only builds the action network, on the CPU, and loads the
+    latest weights the learner published before each rollout.
+
+    Args:
+        worker (int): The index of the worker, which picks its slots.
+        weights (SharedWeights): The action network weights of the learner.
+        rollouts (SharedRollouts): Receives the rollouts.
+    """
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    np.random.seed(seed)
+    s = tf.placeholder(tf.float32, [num_agents, 4])
+    g = tf.placeholder(tf.float32, [num_agents, 2])
+    a = core.network_action(s=s, g=g, obs_radius=config.OBS_RADIUS,
+                            desired_formation=core.leader_formation(num_agents))
+    variables = {v.op.name: v for v in tf.global_variables()}
+    bank = scenario_bank.stream_scenarios(bank_path, num_agents, seed=seed) if bank_path else None
 
-    # Build the training graph
-    s_train, g_train, a_train, loss_list_train, loss_train, acc_list_train = build_training_graph(args.num_agents)
-    zero_ops, accumulate_ops, train_step_h, train_step_a = build_optimizer(loss_train)
-    accumulate_ops.append(loss_list_train)
-    accumulate_ops.append(acc_list_train)
+    with tf.Session() as sess:
+        version = 0
+        while True:
+            version = weights.load(sess, variables, version)
+            s_np, g_np = sample_scenario(num_agents, bank)
+            s_final, states, _, safety_ratios = rollout(
+                s_np, g_np, lambda s_np: (sess.run(a, feed_dict={s: s_np, g: g_np}), None))
+            safety_ratios_lqr = lqr_rollout(s_np, g_np)
+            rollouts.write(
+                worker, np.stack(states), g_np,
+                np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)),
+                np.mean(np.linalg.norm(s_final[:, :2] - g_np, axis=1)),
+                safety_ratios, safety_ratios_lqr)
 
-    accumulation_steps = config.INNER_LOOPS
 
-    with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
+def shared_variables():
+    # the workers only build the action network
+    return [v for v in tf.trainable_variables() if 'action' in v.name]
 
-        if args.model_path:
-            saver.restore(sess, args.model_path)
 
-        state_gain = np.eye(2, 4) + np.eye(2, 4, k=2) * np.sqrt(3)
+def stop_workers(workers, rollouts):
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+    if rollouts is not None:
+        rollouts.close()
 
-        loss_lists_np, acc_lists_np, dist_errors_np, init_dist_errors_np = [], [], [], []
-        safety_ratios_epoch, safety_ratios_epoch_lqr = [], []
+
+def main():
+    args = parse_args()
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    # seeds the scenario generation for reproducible runs
+    np.random.seed(args.seed)
+
+    # Build the training graph. With batch_scenarios, the states of that many
+    # rollouts are trained on in one batched call instead of accumulated one by one
+    if args.num_workers < 0 or args.batch_scenarios < 0:
+        raise ValueError('--num_workers and --batch_scenarios must not be negative.')
+    if args.in_graph_rollout and args.num_workers > 0:
+        raise ValueError('--in_graph_rollout runs the rollouts in the training graph and cannot use --num_workers.')
+    batched = args.batch_scenarios > 0 or args.in_graph_rollout
+    if args.in_graph_rollout:
+        # the whole rollout and the losses on its states run in one call
+        num_scenarios = max(1, args.batch_scenarios)
+        s_rollout, g_rollout, states_rollout, s_final_rollout, safety_rollout = build_rollout_graph(args.num_agents, num_scenarios)
+        num_steps = tf.shape(states_rollout)[0]
+        s_train, g_train, a_train, loss_list_train, loss_train, acc_list_train = build_training_graph(
+            args.num_agents, batched,
+            states=tf.stop_gradient(tf.reshape(states_rollout, [-1, args.num_agents, 4])),
+            goals=tf.reshape(tf.tile(g_rollout[None], [num_steps, 1, 1, 1]), [-1, args.num_agents, 2]))
+    else:
+        s_train, g_train, a_train, loss_list_train, loss_train, acc_list_train = build_training_graph(args.num_agents, batched)
+    if batched:
+        train_step_h, train_step_a = build_batch_optimizer(loss_train)
+    else:
+        zero_ops, accumulate_ops, train_step_h, train_step_a = build_optimizer(loss_train)
+        accumulate_ops.append(loss_list_train)
+        accumulate_ops.append(acc_list_train)
+
+    # with num_workers, rollouts are generated by worker processes and the
+    # main process only computes the gradients on the states they visited,
+    # which they hand over through buffers in shared memory
+    workers, weights, rollouts = [], None, None
+    if args.num_workers > 0:
+        context = multiprocessing.get_context('spawn')
+        weights = SharedWeights(context, shared_variables())
+        rollouts = SharedRollouts(context, args.num_workers, args.num_agents)
+        for i in range(args.num_workers):
+            seed = None if args.seed is None else args.seed + i + 1
+            workers.append(context.Process(
+                target=rollout_worker, daemon=True,
+                args=(i, args.num_agents, args.bank, seed, weights, rollouts)))
+            workers[-1].start()
+
+    try:
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            saver = tf.train.Saver()
+
+            if args.model_path:
+                saver.restore(sess, args.model_path)
+
+            loss_lists_np, acc_lists_np, dist_errors_np, init_dist_errors_np = [], [], [], []
+            safety_ratios_epoch, safety_ratios_epoch_lqr = [], []
         
-        for istep in range(config.TRAIN_STEPS):
-            s_np, g_np = core.generate_data(args.num_agents, config.DIST_MIN_THRES)
-            s_np_lqr, g_np_lqr = np.copy(s_np), np.copy(g_np)
-            init_dist_errors_np.append(np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)))
-            sess.run(zero_ops)
-
-            for i in range(accumulation_steps):
-                a_np, out = sess.run([a_train, accumulate_ops], feed_dict={s_train: s_np, g_train: g_np})
-                if np.random.uniform() < config.ADD_NOISE_PROB:
-                    noise = np.random.normal(size=np.shape(a_np)) * config.NOISE_SCALE
-                    a_np += noise
-                
-                s_np += np.concatenate([s_np[:, 2:], a_np], axis=1) * config.TIME_STEP
-                safety_ratio = 1 - np.mean(core.ttc_dangerous_mask_np(s_np, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK), axis=1)
-                safety_ratios_epoch.append(np.mean(safety_ratio == 1))
-
-                loss_list_np, acc_list_np = out[-2], out[-1]
-                loss_lists_np.append(loss_list_np)
-                acc_lists_np.append(acc_list_np)
-                
-                if np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)) < config.DIST_MIN_CHECK:
-                    break
-
-            for i in range(accumulation_steps):
-                s_ref_lqr = np.concatenate([s_np_lqr[:, :2] - g_np_lqr, s_np_lqr[:, 2:]], axis=1)
-                a_lqr = -s_ref_lqr.dot(state_gain.T)
-                s_np_lqr += np.concatenate([s_np_lqr[:, 2:], a_lqr], axis=1) * config.TIME_STEP
-                s_np_lqr[:, :2] = np.clip(s_np_lqr[:, :2], 0, 1)
-
-                safety_ratio_lqr = 1 - np.mean(core.ttc_dangerous_mask_np(s_np_lqr, config.DIST_MIN_CHECK, config.TIME_TO_COLLISION_CHECK), axis=1)
-                safety_ratios_epoch_lqr.append(np.mean(safety_ratio_lqr == 1))
-
-                if np.mean(np.linalg.norm(s_np_lqr[:, :2] - g_np_lqr, axis=1)) < config.DIST_MIN_CHECK:
-                    break
-
-            dist_errors_np.append(np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)))
-
-            if istep // 10 % 2 == 0:
-                sess.run(train_step_h)
-            else:
-                sess.run(train_step_a)
+            bank = None
+            if args.bank and not workers:
+                bank = scenario_bank.stream_scenarios(args.bank, args.num_agents, seed=args.seed)
+            if workers:
+                weights.publish(sess, shared_variables())
+
+            num_states, start_time = 0, time.time()
+
+            for istep in range(config.TRAIN_STEPS):
+                if not batched:
+                    sess.run(zero_ops)
+                train_step = train_step_h if istep // 10 % 2 == 0 else train_step_a
+
+                rollouts_np = []
+                if args.in_graph_rollout:
+                    # roll out, compute the losses on the visited states and train in one call
+                    scenarios = [sample_scenario(args.num_agents, bank) for _ in range(num_scenarios)]
+                    s_np, g_np = [np.stack(x) for x in zip(*scenarios)]
+                    _, loss_list_np, acc_list_np, num_steps_np, s_final, safety_ratios = sess.run(
+                        [train_step, loss_list_train, acc_list_train, num_steps, s_final_rollout, safety_rollout],
+                        feed_dict={s_rollout: s_np, g_rollout: g_np})
+                    loss_lists_np.append(loss_list_np)
+                    acc_lists_np.append(acc_list_np)
+                    num_states += num_steps_np * num_scenarios
+                    safety_ratios_lqr = lqr_rollout(s_np, g_np)
+                    for b in range(num_scenarios):
+                        # the safety ratios of the graph already cover the whole batch
+                        rollouts_np.append((
+                            None, g_np[b],
+                            np.mean(np.linalg.norm(s_np[b, :, :2] - g_np[b], axis=1)),
+                            np.mean(np.linalg.norm(s_final[b, :, :2] - g_np[b], axis=1)),
+                            list(safety_ratios) if b == 0 else [], safety_ratios_lqr[b]))
+                else:
+                    for _ in range(max(1, args.batch_scenarios)):
+                        if workers:
+                            rollouts_np.append(rollouts.read(workers))
+                            continue
+                        s_np, g_np = sample_scenario(args.num_agents, bank)
+                        safety_ratios_lqr = lqr_rollout(s_np, g_np)
+                        if batched:
+                            step = lambda s_np: (sess.run(a_train, feed_dict={s_train: s_np[None], g_train: g_np[None]})[0], None)
+                        else:
+                            step = lambda s_np: sess.run([a_train, accumulate_ops], feed_dict={s_train: s_np, g_train: g_np})
+                        s_final, states, outs, safety_ratios = rollout(s_np, g_np, step)
+                        if not batched:
+                            # the gradients were accumulated while rolling out
+                            for out in outs:
+                                loss_lists_np.append(out[-2])
+                                acc_lists_np.append(out[-1])
+                        rollouts_np.append((
+                            np.stack(states), g_np,
+                            np.mean(np.linalg.norm(s_np[:, :2] - g_np, axis=1)),
+                            np.mean(np.linalg.norm(s_final[:, :2] - g_np, axis=1)),
+                            safety_ratios, safety_ratios_lqr))
+
+                    states = np.concatenate([rollout_np[0] for rollout_np in rollouts_np])
+                    goals = np.concatenate([np.repeat(rollout_np[1][None], len(rollout_np[0]), axis=0) for rollout_np in rollouts_np])
+                    num_states += len(states)
+                    if batched:
+                        # one call computes the losses and gradients of the whole minibatch
+                        _, loss_list_np, acc_list_np = sess.run(
+                            [train_step, loss_list_train, acc_list_train], feed_dict={s_train: states, g_train: goals})
+                        loss_lists_np.append(loss_list_np)
+                        acc_lists_np.append(acc_list_np)
+                    elif workers:
+                        # accumulate the gradients over the states of a finished rollout
+                        for s_np, g_np in zip(states, goals):
+                            out = sess.run(accumulate_ops, feed_dict={s_train: s_np, g_train: g_np})
+                            loss_lists_np.append(out[-2])
+                            acc_lists_np.append(out[-1])
+
+                for _, _, init_dist_error, dist_error, safety_ratios, safety_ratios_lqr in rollouts_np:
+                    init_dist_errors_np.append(init_dist_error)
+                    dist_errors_np.append(dist_error)
+                    safety_ratios_epoch.extend(safety_ratios)
+                    safety_ratios_epoch_lqr.extend(safety_ratios_lqr)
+
+                if not batched:
+                    # apply the accumulated gradients
+                    sess.run(train_step)
+
+                if workers and istep % config.WEIGHT_SYNC_STEPS == 0:
+                    weights.publish(sess, shared_variables())
             
-            if istep % config.DISPLAY_STEPS == 0:
-                print(f'Step: {istep}, Loss: {np.mean(loss_lists_np, axis=0)}, Accuracy: {count_accuracy(acc_lists_np)}')
-                loss_lists_np, acc_lists_np, dist_errors_np, safety_ratios_epoch, safety_ratios_epoch_lqr = [], [], [], [], []
+                if istep % config.DISPLAY_STEPS == 0:
+                    print(f'Step: {istep}, Loss: {np.mean(loss_lists_np, axis=0)}, Accuracy: {count_accuracy(acc_lists_np)}, States/s: {num_states / (time.time() - start_time):.1f}')
+                    num_states, start_time = 0, time.time()
+                    loss_lists_np, acc_lists_np, dist_errors_np, safety_ratios_epoch, safety_ratios_epoch_lqr = [], [], [], [], []
 
-            if istep % config.SAVE_STEPS == 0 or istep + 1 == config.TRAIN_STEPS:
-                saver.save(sess, f'models/model_iter_{istep}')
+                if istep % config.SAVE_STEPS == 0 or istep + 1 == config.TRAIN_STEPS:
+                    saver.save(sess, f'models/model_iter_{istep}')
+    finally:
+        stop_workers(workers, rollouts)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
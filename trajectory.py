@@ -0,0 +1,170 @@
+import contextlib
+
+import h5py
+import numpy as np
+
+# the number of steps buffered in memory and written to disk as one HDF5 chunk
+CHUNK_STEPS = 64
+
+
+class TrajectoryWriter(object):
+    """ Streams the steps of trajectories into a chunked, compressed HDF5 file.
+
+    Every field of a group becomes a dataset whose first axis is the step.
+    Steps are gathered in a preallocated buffer of chunk_steps rows and written
+    as one compressed chunk once it is full, so memory stays bounded however
+    long the run is.
+
+    Args:
+        path (str): The .h5 file to write.
+        chunk_steps (int): The number of steps per chunk.
+        compression (str): The HDF5 filter, e.g. 'gzip' or 'lzf', or None.
+    """
+
+    def __init__(self, path, chunk_steps=CHUNK_STEPS, compression='gzip'):
+        self.file = h5py.File(path, 'w')
+        self.chunk_steps = chunk_steps
+        self.compression = compression
+        # dataset name -> [buffer, number of buffered steps]
+        self._buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, group, **fields):
+        """ Appends one step of each field to the datasets of group. """
+        self.extend(group, **{name: np.expand_dims(value, 0) for name, value in fields.items()})
+
+    def extend(self, group, **fields):
+        """ Appends a block of steps, the first axis of each field, to group. """
+        for name, block in fields.items():
+            key = group + '/' + name
+            block = np.asarray(block)
+            if key not in self._buffers:
+                self.file.create_dataset(
+                    key, shape=(0,) + block.shape[1:], maxshape=(None,) + block.shape[1:],
+                    chunks=(self.chunk_steps,) + block.shape[1:], dtype=block.dtype,
+                    compression=self.compression, shuffle=self.compression is not None)
+                self._buffers[key] = [np.empty((self.chunk_steps,) + block.shape[1:], block.dtype), 0]
+            buffer = self._buffers[key]
+            while len(block) > 0:
+                size = min(len(block), self.chunk_steps - buffer[1])
+                buffer[0][buffer[1]:buffer[1] + size] = block[:size]
+                buffer[1] += size
+                block = block[size:]
+                if buffer[1] == self.chunk_steps:
+                    self._write(key)
+
+    def save(self, group, **arrays):
+        """ Stores arrays that have no step axis, e.g. the goals, in group. """
+        for name, value in arrays.items():
+            self.file.create_dataset(group + '/' + name, data=value)
+
+    def set_attrs(self, group, **attrs):
+        self.file.require_group(group).attrs.update(attrs)
+
+    def _write(self, key):
+        buffer, count = self._buffers[key]
+        if count == 0:
+            return
+        dataset = self.file[key]
+        dataset.resize(len(dataset) + count, axis=0)
+        dataset[-count:] = buffer[:count]
+        self._buffers[key][1] = 0
+
+    def flush(self):
+        """ Writes the partially filled buffers, so the file can be read. """
+        for key in self._buffers:
+            self._write(key)
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+
+
+@contextlib.contextmanager
+def _open(source):
+    # a path is opened for reading, an open file or group is used as is
+    if isinstance(source, str):
+        with h5py.File(source, 'r') as f:
+            yield f
+    else:
+        yield source
+
+
+def list_trajectories(source):
+    """ Returns the names of the groups holding recorded states, in order. """
+    names = []
+    with _open(source) as f:
+        f.visititems(lambda name, item: names.append(name.rsplit('/', 1)[0])
+                     if name.endswith('states') and isinstance(item, h5py.Dataset) else None)
+    return sorted(names)
+
+
+def read_blocks(source, group, fields, block_steps=CHUNK_STEPS):
+    """ Yields the steps of a group block by block, without loading the run.
+
+    Args:
+        source (str or h5py.File): The recorded file.
+        group (str): The group of the trajectory.
+        fields (list): The names of the fields to read.
+        block_steps (int): The number of steps per block.
+    Yields:
+        blocks (list): The (T, ...) block of each field, T <= block_steps.
+    """
+    with _open(source) as f:
+        datasets = [f[group][name] for name in fields]
+        num_steps = min(len(d) for d in datasets)
+        for start in range(0, num_steps, block_steps):
+            yield [d[start:start + block_steps] for d in datasets]
+
+
+def replay(source, group, fields):
+    """ Yields the fields of a group one step at a time. """
+    for blocks in read_blocks(source, group, fields):
+        for step in zip(*blocks):
+            yield step
+
+
+def trajectory_metrics(source, group):
+    """ Reduces a recorded trajectory of B scenarios to evaluation metrics.
+
+    The steps are read a block at a time. A scenario that stopped early is
+    only counted up to its num_steps, when the group stores them.
+
+    Returns:
+        metrics (dict): 'safety_rate', the fraction of agents safe over all
+            steps, 'safety_reward' (B,), minus the mean number of unsafe steps
+            per agent, and 'dist_error' (B,), the mean final distance to the goals.
+    """
+    with _open(source) as f:
+        goals = f[group]['goals'][()]
+        num_steps = f[group]['num_steps'][()] if 'num_steps' in f[group] else None
+        num_safe, num_total, start = 0.0, 0, 0
+        unsafe_steps = np.zeros(goals.shape[:-1])
+        final = np.zeros(goals.shape[:-1] + (4,))
+        for states, safe in read_blocks(f, group, ['states', 'safe']):
+            steps = start + np.arange(len(states))
+            if num_steps is None:
+                valid = np.ones((len(states), goals.shape[0]), dtype=bool)
+            else:
+                valid = steps[:, None] < num_steps
+            weights = valid[..., None].astype(np.float64)
+            num_safe += np.sum(safe * weights)
+            num_total += np.sum(valid) * goals.shape[-2]
+            unsafe_steps += np.sum((1 - safe) * weights, axis=0)
+            # the last valid step of each scenario so far
+            last = np.where(valid, steps[:, None], -1).argmax(axis=0)
+            has_valid = np.any(valid, axis=0)
+            final[has_valid] = states[last[has_valid], np.flatnonzero(has_valid)]
+            start += len(states)
+    return {
+        'safety_rate': num_safe / max(num_total, 1),
+        'safety_reward': -np.mean(unsafe_steps, axis=-1),
+        'dist_error': np.mean(np.linalg.norm(final[..., :2] - goals, axis=-1), axis=-1),
+    }